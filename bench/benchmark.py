@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+"""
+benchmark.py
+
+Benchmarks for the hook pipeline, run against throwaway generated git repositories.
+
+    benchmark.py run [options] [-o results.json]
+    benchmark.py run --rev <revision> -o old.json
+    benchmark.py compare old.json new.json
+
+`run` builds a local repository with a commit in progress, times precommit.main() end to end
+in several configurations, and times the hot functions on the same files. With --rev, the
+hooks are taken from another revision of this repository (via git archive), so two revisions
+can be measured with the same benchmark code and then compared. Everything runs offline.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+DEFAULT_HOOKS_DIR = os.path.join(REPO_ROOT, "hooks")
+
+FUNCTION_TEMPLATE = '''def %(name)s(a, b=%(number)d):
+%(i)s"""Return a number computed from a and b."""
+%(i)stotal = a + b
+%(i)sfor i in range(%(number)d):
+%(i)s%(i)sif i %% 3 == 0:
+%(i)s%(i)s%(i)stotal += i
+%(i)s%(i)selse:
+%(i)s%(i)s%(i)stotal -= 1
+%(i)sreturn total
+
+
+'''
+
+# a mix of tabs and spaces that tabnanny calls ambiguous, but Python 2 accepts
+TAB_FUNCTION_TEMPLATE = '''def %(name)s(a):
+    if a:
+\tif a > 1:
+            return a
+    return 0
+
+
+'''
+
+PEP8_FUNCTION_TEMPLATE = '''def %(name)s(a):
+    total=a + %(number)d
+    return total
+
+
+'''
+
+CLASS_TEMPLATE = '''class %(name)s(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def double(self):
+        return self.value * 2
+
+
+'''
+
+
+def generate_module(rng, lines, tab_violation=False, indent_violation=False, pep8_violation=False):
+    """
+    Generate a module of roughly `lines` lines, with at most one of each requested violation.
+    """
+    blocks = ['"""\nGenerated module.\n"""\n\nimport os\n\n\n']
+    line_count = 6
+    while line_count < lines:
+        name = "name_%d" % line_count
+        if rng.random() < 0.2:
+            block = CLASS_TEMPLATE % dict(name=name.title().replace("_", ""))
+        else:
+            block = FUNCTION_TEMPLATE % dict(name=name, number=rng.randint(1, 100), i="    ")
+        blocks.append(block)
+        line_count += block.count("\n")
+
+    violations = []
+    if tab_violation:
+        violations.append(TAB_FUNCTION_TEMPLATE % dict(name="tabbed"))
+    if indent_violation:
+        violations.append(FUNCTION_TEMPLATE % dict(name="two_spaces", number=7, i="  "))
+    if pep8_violation:
+        violations.append(PEP8_FUNCTION_TEMPLATE % dict(name="crowded", number=3))
+    for block in violations:
+        blocks.insert(rng.randint(1, len(blocks)), block)
+    # reindent drops trailing blank lines
+    return "".join(blocks).rstrip("\n") + "\n"
+
+
+def git(repo, *args):
+    process = subprocess.Popen(("git",) + args, cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError("git %s failed" % " ".join(args), err)
+    return out
+
+
+def generate_repo(path, options):
+    """
+    Create a repository at path whose index holds a commit in progress: options.files changed
+    Python files, options.modified_share of them modified versions of files in HEAD and the rest
+    newly added.
+
+    The tab, indent and pep8 rates are the share of changed files with that kind of violation.
+    Returns the paths of the changed files.
+    """
+    rng = random.Random(options.seed)
+    os.makedirs(path)
+    git(path, "init", "-q")
+    git(path, "config", "user.name", "Benchmark")
+    git(path, "config", "user.email", "benchmark@example.com")
+
+    modified_count = int(round(options.files * options.modified_share))
+    changed = []
+    for index in range(options.files):
+        filename = "pkg%d/module_%d.py" % (index % 10, index)
+        changed.append(filename)
+        if index < modified_count:
+            write_file(path, filename, generate_module(rng, options.lines))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "--allow-empty", "-m", "Initial files")
+
+    for filename in changed:
+        code = generate_module(rng, options.lines,
+                               tab_violation=rng.random() < options.tab_rate,
+                               indent_violation=rng.random() < options.indent_rate,
+                               pep8_violation=rng.random() < options.pep8_rate)
+        write_file(path, filename, code)
+    git(path, "add", "-A")
+    return changed
+
+
+def write_file(repo, filename, code):
+    full_path = os.path.join(repo, filename)
+    if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+    with open(full_path, "wb") as out_file:
+        out_file.write(code)
+
+
+def set_repo_config(repo, settings):
+    for key, value in settings:
+        git(repo, "config", "pygithooks." + key, value)
+
+
+def time_runs(func, repeat):
+    """
+    Call func once to warm up, then `repeat` more times. Returns (timings, last return value).
+    """
+    result = func()
+    timings = []
+    for unused in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return timings, result
+
+
+def summarize(timings, **extra):
+    ordered = sorted(timings)
+    summary = dict(runs=timings,
+                   min=ordered[0],
+                   median=ordered[len(ordered) // 2],
+                   mean=sum(ordered) / len(ordered))
+    summary.update(extra)
+    return summary
+
+
+class Silenced(object):
+    """
+    Context manager sending sys.stdout to /dev/null, for the hooks' chatter.
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def run_precommit_main(repo):
+    """
+    Run precommit.main() as the pre-commit hook would, in repo. Returns its exit code.
+    """
+    import precommit
+    import util
+    old_cwd, old_argv = os.getcwd(), sys.argv
+    os.chdir(repo)
+    sys.argv = ["precommit.py"]
+    try:
+        # configuration may have changed since the last run
+        if hasattr(util, "reset_config_snapshot"):
+            util.reset_config_snapshot()
+        try:
+            with Silenced():
+                return precommit.main()
+        except SystemExit, e:
+            return e.code
+    finally:
+        os.chdir(old_cwd)
+        sys.argv = old_argv
+
+
+def run_precommit_process(repo, hooks_dir):
+    """
+    Run the pre-commit hook as a separate process, as git does. Returns its exit code.
+    """
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call([sys.executable, os.path.join(hooks_dir, "precommit.py")],
+                               cwd=repo, stdout=devnull, stderr=devnull)
+
+
+def bench_end_to_end(repo, hooks_dir, repeat):
+    """
+    Time the whole hook on the repository's staged commit, in a few configurations.
+    """
+    scenarios = [
+        ("precommit.main (default jobs, no cache)", [("cache", "false")], run_precommit_main),
+        ("precommit.main (1 job, no cache)", [("cache", "false"), ("jobs", "1")], run_precommit_main),
+        ("precommit.main (warm cache)", [("cache", "true")], run_precommit_main),
+        ("precommit.py process (no cache)", [("cache", "false")],
+         lambda repo: run_precommit_process(repo, hooks_dir)),
+    ]
+    results = {}
+    for name, settings, run in scenarios:
+        set_repo_config(repo, settings)
+        timings, exit_code = time_runs(lambda: run(repo), repeat)
+        results[name] = summarize(timings, exit_code=exit_code)
+        git(repo, "config", "--remove-section", "pygithooks")
+    return results
+
+
+def bench_functions(repo, filenames, repeat):
+    """
+    Time the hot functions on the generated files. Each timing covers every file once.
+    """
+    import check_indentation
+    import check_tabs
+    import reindent
+    import util
+
+    codes = []
+    for filename in filenames:
+        with open(os.path.join(repo, filename), "rb") as code_file:
+            codes.append((filename, code_file.read()))
+
+    def reindent_all():
+        for filename, code in codes:
+            reindent.Reindenter(StringIO.StringIO(code)).run()
+
+    def indentation_diff_all():
+        return sum(check_indentation.get_correct_indentation_diff(code, filename) is not None
+                   for filename, code in codes)
+
+    tabs_hook = check_tabs.CheckTabs()
+
+    def check_tabs_all():
+        if not hasattr(tabs_hook, "source_passes"):
+            # revisions before hooks took in-memory source
+            return sum(not tabs_hook.file_passes(os.path.join(repo, filename), original_filename=filename)[0]
+                       for filename, code in codes)
+        from source import SourceFile
+        return sum(not tabs_hook.source_passes(SourceFile(code, filename))[0] for filename, code in codes)
+
+    def run_command_many():
+        old_cwd = os.getcwd()
+        os.chdir(repo)
+        try:
+            for unused in range(20):
+                util.run_command("git rev-parse HEAD")
+        finally:
+            os.chdir(old_cwd)
+
+    results = {}
+    for name, func, calls in [("reindent.Reindenter.run", reindent_all, len(codes)),
+                              ("check_indentation.get_correct_indentation_diff", indentation_diff_all, len(codes)),
+                              ("CheckTabs.file_passes", check_tabs_all, len(codes)),
+                              ("util.run_command", run_command_many, 20)]:
+        timings, value = time_runs(func, repeat)
+        results[name] = summarize(timings, calls=calls)
+        if value is not None:
+            # files flagged, to spot behavior changes between revisions
+            results[name]["flagged"] = value
+    return results
+
+
+def describe_revision(hooks_dir):
+    try:
+        revision = git(hooks_dir, "rev-parse", "HEAD").strip()
+        if git(hooks_dir, "status", "--porcelain", "--untracked-files=no", "--", ".").strip():
+            revision += "-dirty"
+        return revision
+    except (RuntimeError, OSError):
+        # an exported tree; the caller knows the revision
+        return None
+
+
+def run_suite(options):
+    hooks_dir = os.path.abspath(options.hooks_dir)
+    sys.path.insert(0, hooks_dir)
+
+    work_dir = tempfile.mkdtemp(prefix="pygithooks-bench-")
+    try:
+        repo = os.path.join(work_dir, "repo")
+        filenames = generate_repo(repo, options)
+        results = {}
+        results.update(bench_functions(repo, filenames, options.repeat))
+        results.update(bench_end_to_end(repo, hooks_dir, options.repeat))
+    finally:
+        shutil.rmtree(work_dir, True)
+
+    params = dict((key, getattr(options, key)) for key in ("files", "lines", "modified_share", "tab_rate",
+                                                           "indent_rate", "pep8_rate", "seed", "repeat"))
+    return dict(revision=options.revision_name or describe_revision(hooks_dir),
+                created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                params=params,
+                results=results)
+
+
+def export_revision(revision, dest):
+    """
+    Write the hooks directory of `revision` of this repository to dest, using the current
+    checkout's pep8 (a submodule, which git archive leaves out) if the export lacks one.
+    """
+    archive = subprocess.Popen(["git", "archive", "--format=tar", revision, "hooks"],
+                               cwd=REPO_ROOT, stdout=subprocess.PIPE)
+    untar = subprocess.Popen(["tar", "-x", "-C", dest], stdin=archive.stdout)
+    archive.stdout.close()
+    if untar.wait() or archive.wait():
+        raise RuntimeError("could not export hooks from revision %s" % revision)
+    hooks_dir = os.path.join(dest, "hooks")
+    exported_pep8 = os.path.join(hooks_dir, "pep8", "pep8.py")
+    current_pep8 = os.path.join(DEFAULT_HOOKS_DIR, "pep8", "pep8.py")
+    if not os.path.exists(exported_pep8) and os.path.exists(current_pep8):
+        if not os.path.isdir(os.path.dirname(exported_pep8)):
+            os.makedirs(os.path.dirname(exported_pep8))
+        shutil.copy(current_pep8, exported_pep8)
+    return hooks_dir
+
+
+def run_revision(revision, argv):
+    """
+    Run the suite in a fresh interpreter against the hooks of another revision.
+    """
+    export_dir = tempfile.mkdtemp(prefix="pygithooks-rev-")
+    try:
+        hooks_dir = export_revision(revision, export_dir)
+        full_revision = git(REPO_ROOT, "rev-parse", revision).strip()
+        return subprocess.call([sys.executable, os.path.abspath(__file__), "run"] + argv +
+                               ["--hooks-dir", hooks_dir, "--revision-name", full_revision])
+    finally:
+        shutil.rmtree(export_dir, True)
+
+
+def compare(old, new, threshold):
+    """
+    Print old and new median timings side by side. Returns 1 if anything got slower by more
+    than threshold (a ratio), or changed behavior, else 0.
+    """
+    print "old: %s (%s)" % (old["revision"], old["created"])
+    print "new: %s (%s)" % (new["revision"], new["created"])
+    if old["params"] != new["params"]:
+        print "warning: the runs used different parameters; timings may not be comparable"
+    regressed = False
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        if name not in old["results"] or name not in new["results"]:
+            print "%-50s only in %s" % (name, "old" if name in old["results"] else "new")
+            continue
+        old_result, new_result = old["results"][name], new["results"][name]
+        ratio = new_result["median"] / max(old_result["median"], 1e-9)
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            regressed = True
+        for key in ("exit_code", "flagged"):
+            if old_result.get(key) != new_result.get(key):
+                flag += "  %s changed: %s -> %s" % (key, old_result.get(key), new_result.get(key))
+                regressed = True
+        print "%-50s %9.4fs %9.4fs  x%.2f%s" % (name, old_result["median"], new_result["median"], ratio, flag)
+    return int(regressed)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = optparse.OptionParser(usage="%prog run [options] | %prog compare OLD.json NEW.json")
+    parser.add_option("-o", "--output", help="write results as JSON to this file (default: stdout)")
+    parser.add_option("--rev", help="benchmark the hooks from this revision of the repository")
+    parser.add_option("--hooks-dir", default=DEFAULT_HOOKS_DIR, help="benchmark the hooks in this directory")
+    parser.add_option("--revision-name", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--files", type="int", default=200, help="changed files in the commit [%default]")
+    parser.add_option("--lines", type="int", default=300, help="approximate lines per file [%default]")
+    parser.add_option("--modified-share", type="float", default=0.5,
+                      help="share of changed files that modify a file in HEAD; the rest are added [%default]")
+    parser.add_option("--tab-rate", type="float", default=0.05,
+                      help="share of changed files with an ambiguous tab [%default]")
+    parser.add_option("--indent-rate", type="float", default=0.05,
+                      help="share of changed files with bad indentation [%default]")
+    parser.add_option("--pep8-rate", type="float", default=0.1,
+                      help="share of changed files with a pep8 problem [%default]")
+    parser.add_option("--seed", type="int", default=1, help="random seed for file generation [%default]")
+    parser.add_option("--repeat", type="int", default=3, help="timed runs per benchmark [%default]")
+    parser.add_option("--threshold", type="float", default=1.1,
+                      help="compare: ratio of medians counted as a slowdown [%default]")
+    options, args = parser.parse_args(argv)
+
+    if args[:1] == ["compare"] and len(args) == 3:
+        with open(args[1]) as old_file:
+            old = json.load(old_file)
+        with open(args[2]) as new_file:
+            new = json.load(new_file)
+        return compare(old, new, options.threshold)
+
+    if args != ["run"]:
+        parser.error("expected `run` or `compare OLD.json NEW.json`")
+
+    if options.rev:
+        rev_argv = [arg for arg in argv if arg != "run"]
+        rev_index = rev_argv.index("--rev") if "--rev" in rev_argv else None
+        if rev_index is not None:
+            del rev_argv[rev_index:rev_index + 2]
+        else:
+            rev_argv = [arg for arg in rev_argv if not arg.startswith("--rev=")]
+        return run_revision(options.rev, rev_argv)
+
+    report = json.dumps(run_suite(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as out_file:
+            out_file.write(report + "\n")
+    else:
+        print report
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+differential.py
+
+Checks that reworked hook internals give exactly the results of the reference implementations.
+
+    differential.py [PATH ...]
+
+Runs each check on generated modules, on pathological inputs and on every .py file under the
+given paths (files or directories; the standard library is a good corpus), printing any
+mismatches and the time each implementation took. Exits with status 1 on a mismatch.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+import itertools
+import optparse
+import os
+import random
+import re
+import sys
+import time
+import tokenize
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "hooks"))
+
+import benchmark
+import check_indentation
+import check_tabs
+import reindent
+import reindent_reference
+from source import SourceFile
+
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? ")
+
+
+def generated_inputs(count, seed):
+    """
+    Generate (name, code) pairs: generated modules with violations, and pathological inputs.
+    """
+    rng = random.Random(seed)
+    for index in range(count):
+        yield "generated_%d.py" % index, benchmark.generate_module(rng, rng.randint(10, 400),
+                                                                   tab_violation=rng.random() < 0.3,
+                                                                   indent_violation=rng.random() < 0.3,
+                                                                   pep8_violation=rng.random() < 0.3)
+
+    # Long runs of indented comments at many different indentations, which the reference
+    # implementation scans over once per distinct indentation.
+    blocks = ["def f():\n"]
+    for index in range(20000):
+        blocks.append(" " * (1 + index % 300) + "# comment %d\n" % index)
+    blocks.append("  return 1\n")
+    yield "comment_run.py", "".join(blocks)
+
+    # Many scattered indentation fixes in one large file, where difflib's matching is slow.
+    blocks = [benchmark.FUNCTION_TEMPLATE % dict(name="f%d" % index, number=index, i="  " if index % 3 else "    ")
+              for index in range(600)]
+    yield "many_fixes.py", "".join(blocks).rstrip("\n") + "\n"
+
+    # Hanging comments after shifted statements, comments before any statement, trailing
+    # blank lines, tabs, and a missing final newline.
+    yield "hanging.py", ("# leading\n\n"
+                         "def f():\n"
+                         "  x = 1  # one\n"
+                         "        # hanging under the comment\n"
+                         "  if x:\n"
+                         "\ty = [1,\n"
+                         "  2]\n"
+                         "          # deeper hanging\n"
+                         "\treturn y\n"
+                         "   # odd\n\n\n")
+    yield "no_newline.py", "if 1:\n  pass"
+    yield "empty.py", ""
+    yield "only_blank.py", "\n\n  \n"
+
+
+def corpus_inputs(paths):
+    """
+    Generate (name, code) for every .py file under paths.
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            filenames = [path]
+        else:
+            filenames = []
+            for dirpath, dirnames, names in os.walk(path):
+                dirnames.sort()
+                filenames.extend(os.path.join(dirpath, name) for name in sorted(names) if name.endswith(".py"))
+        for filename in filenames:
+            with open(filename, "rb") as code_file:
+                yield filename, code_file.read()
+
+
+def reindent_output(module, code):
+    """
+    (changed, output) from module's Reindenter, or the error it raised.
+    """
+    reindenter = module.Reindenter(StringIO.StringIO(code))
+    try:
+        changed = reindenter.run()
+    except (tokenize.TokenError, IndentationError, SyntaxError), e:
+        return "error: %s" % e.__class__.__name__
+    output = StringIO.StringIO()
+    reindenter.write(output)
+    return bool(changed), output.getvalue()
+
+
+def check_reindent(inputs):
+    """
+    Compare reindent.Reindenter with the reference implementation. Returns the number of mismatches.
+    """
+    mismatches = files = 0
+    times = {reindent_reference: 0.0, reindent: 0.0}
+    for name, code in inputs:
+        files += 1
+        outputs = []
+        for module in (reindent_reference, reindent):
+            start = time.time()
+            outputs.append(reindent_output(module, code))
+            times[module] += time.time() - start
+        if outputs[0] != outputs[1]:
+            mismatches += 1
+            print "reindent mismatch: %s" % name
+    print "reindent: %d files, %d mismatches; reference %.2fs, current %.2fs" % (files, mismatches,
+                                                                                 times[reindent_reference],
+                                                                                 times[reindent])
+    return mismatches
+
+
+def apply_unified_diff(code, diff):
+    """
+    Apply a unified diff to code, returning the patched code. Raises ValueError if it doesn't apply.
+    """
+    lines = StringIO.StringIO(code).readlines()
+    diff_lines = StringIO.StringIO(diff).readlines()[2:]
+    patched = []
+    position = 0
+    index = 0
+    while index < len(diff_lines):
+        match = HUNK_HEADER_RE.match(diff_lines[index])
+        if not match:
+            raise ValueError("expected a hunk header", diff_lines[index])
+        first = int(match.group(1))
+        # empty ranges start at the line before them
+        start = first if match.group(2) == "0" else first - 1
+        if start < position:
+            raise ValueError("overlapping hunks", diff_lines[index])
+        patched.extend(lines[position:start])
+        position = start
+        index += 1
+        while index < len(diff_lines) and not diff_lines[index].startswith("@@"):
+            tag, text = diff_lines[index][0], diff_lines[index][1:]
+            index += 1
+            if index < len(diff_lines) and diff_lines[index].startswith("\\"):
+                # "\ No newline at end of file"
+                text = text[:-1]
+                index += 1
+            if tag in " -":
+                if position >= len(lines) or lines[position] != text:
+                    raise ValueError("diff doesn't match line %d" % (position + 1))
+                position += 1
+            if tag in " +":
+                patched.append(text)
+    patched.extend(lines[position:])
+    return "".join(patched)
+
+
+def check_indentation_diff(inputs):
+    """
+    Compare check_indentation.get_correct_indentation_diff with the difflib-based reference.
+
+    The diffs must be identical, or else applying the new one must give exactly the reindented
+    code: difflib sometimes matches lines differently, and splits lines on "\\r" too.
+    Returns the number of mismatches.
+    """
+    mismatches = files = identical = 0
+    times = {"reference": 0.0, "current": 0.0}
+    for name, code in inputs:
+        files += 1
+        start = time.time()
+        try:
+            reference_diff = reindent_reference.get_correct_indentation_diff(code, name)
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            continue
+        times["reference"] += time.time() - start
+        start = time.time()
+        diff = check_indentation.get_correct_indentation_diff(code, name)
+        times["current"] += time.time() - start
+        if diff == reference_diff:
+            identical += 1
+            continue
+        try:
+            if reference_diff is None or diff is None:
+                raise ValueError("only one diff is empty")
+            expected = reindent_output(reindent_reference, code)[1]
+            if apply_unified_diff(code, diff) != expected:
+                raise ValueError("patched code differs from reindented code")
+        except ValueError, e:
+            mismatches += 1
+            print "indentation diff mismatch: %s: %s" % (name, e.args[0])
+    print "indentation diff: %d files, %d identical, %d mismatches; reference %.2fs, current %.2fs" % (
+        files, identical, mismatches, times["reference"], times["current"])
+    return mismatches
+
+
+def check_fast_paths(inputs):
+    """
+    Check that whenever a hook's fast path says a file passes, the full check agrees.
+    Returns the number of files where it doesn't.
+    """
+    hooks = [check_tabs.CheckTabs(), check_indentation.CheckIndentation()]
+    files = 0
+    decided = dict((hook, 0) for hook in hooks)
+    mismatches = dict((hook, 0) for hook in hooks)
+    times = dict(((hook, path), 0.0) for hook in hooks for path in ("fast", "full"))
+    for name, code in inputs:
+        files += 1
+        for hook in hooks:
+            start = time.time()
+            fast_passes = hook.fast_path(SourceFile(code, name))
+            times[hook, "fast"] += time.time() - start
+            start = time.time()
+            passes, unused_error_message = hook.source_passes(SourceFile(code, name))
+            times[hook, "full"] += time.time() - start
+            if fast_passes:
+                decided[hook] += 1
+                if not passes:
+                    mismatches[hook] += 1
+                    print "unsound fast path: %s passes %s, but the full check fails it" % (hook, name)
+    for hook in hooks:
+        print "fast path of %s: %d files, %d decided, %d mismatches; fast path %.2fs, full check %.2fs" % (
+            hook, files, decided[hook], mismatches[hook], times[hook, "fast"], times[hook, "full"])
+    return sum(mismatches.values())
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [PATH ...]")
+    parser.add_option("--generated", type="int", default=200, help="generated modules to check [%default]")
+    parser.add_option("--seed", type="int", default=1, help="random seed for generated modules [%default]")
+    options, paths = parser.parse_args(argv)
+
+    def inputs():
+        return itertools.chain(generated_inputs(options.generated, options.seed), corpus_inputs(paths))
+
+    mismatches = check_reindent(inputs())
+    mismatches += check_indentation_diff(inputs())
+    mismatches += check_fast_paths(inputs())
+    return int(bool(mismatches))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Whole-tree audit: run the hooks on every Python file in a commit or tree, e.g. nightly in CI.
+
+Uses the same engine, hooks and configuration as the pre-commit hook. The file list and the
+file contents are both streamed from git, and only a bounded number of files are in flight
+at once, so memory use doesn't grow with the size of the tree.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+import time
+
+from blobs import BlobReader
+from check_external import batch_checks
+from engine import FileCheck, run_checks
+from selection import FileSelector
+import tracing
+from util import stream_records
+
+
+def tree_files(tree_ish):
+    """
+    Generate (object_id, path, size) for every regular file in tree_ish, as git lists them.
+
+    Symlinks and submodules are skipped.
+    """
+    for record in stream_records(["git", "ls-tree", "-r", "-l", "-z", "--full-tree", tree_ish]):
+        info, tab, path = record.partition("\t")
+        mode, object_type, object_id, size = info.split()
+        if object_type == "blob" and mode != "120000":
+            yield object_id, path, int(size)
+
+
+def audit_candidates(tree_ish, selector, max_file_size=0, oversized=None):
+    """
+    Generate (object_id, path, hook_indexes) for every Python file in tree_ish that some hook
+    applies to, as chosen by selector, a selection.FileSelector.
+
+    Files over max_file_size bytes (unless it is 0) are left out, and appended to oversized as (path, size).
+    Those that would only be Python files with a shebang are left out without looking.
+    """
+    def selections():
+        for object_id, path, size in tree_files(tree_ish):
+            hook_indexes, needs_shebang = selector.select(path)
+            if hook_indexes is None:
+                continue
+            if max_file_size and size > max_file_size:
+                if not needs_shebang:
+                    oversized.append((path, size))
+                continue
+            if hook_indexes:
+                yield (object_id, path, hook_indexes), hook_indexes, needs_shebang
+
+    for candidate, unused_hook_indexes in selector.with_python_shebangs(selections(), lambda candidate: candidate[0]):
+        yield candidate
+
+
+def audit_checks(blob_reader, candidates):
+    """
+    Generate a FileCheck for each candidate, streaming its contents from git.
+
+    Like precommit.make_file_checks, errors are reported through FileCheck.error.
+    """
+    try:
+        blobs = tracing.traced(blob_reader.read_blobs(candidates, object_name=lambda candidate: candidate[0]),
+                               "read blob", "blob", lambda response: dict(object=response[1], bytes=len(response[2] or "")))
+        for (object_id, path, hook_indexes), unused_object_id, code in blobs:
+            if code is None:
+                yield FileCheck(path, None, hook_indexes, error="could not read %s (%s)" % (path, object_id))
+                return
+            yield FileCheck(path, code, hook_indexes, object_id=object_id)
+    except (RuntimeError, EnvironmentError), e:
+        yield FileCheck(None, None, [], error="\n".join(map(str, e.args)))
+
+
+def audit_tree(tree_ish, hooks, jobs=1, cache=None, debug=False, max_file_size=0, selector=None,
+               max_file_size_action="warn"):
+    """
+    Check every Python file in tree_ish, printing problems and then a summary. selector chooses
+    the files each hook checks; by default, those with a .py extension.
+
+    Files over max_file_size are named, and counted in the summary, unless max_file_size_action
+    is "skip".
+
+    Returns the exit code: 1 if any file failed, else 0.
+    """
+    start_time = time.time()
+    fast_path_counts = {}
+    files_checked = 0
+    failures_by_hook = {}
+    internal_errors = 0
+
+    if selector is None:
+        selector = FileSelector(hooks)
+    blob_reader = BlobReader()
+    oversized = []
+    checks = audit_checks(blob_reader, audit_candidates(tree_ish, selector, max_file_size, oversized))
+    checks = batch_checks(checks, hooks, jobs, cache)
+    with tracing.span("check files"):
+        for result in run_checks(hooks, checks, jobs=jobs, cache=cache, fast_path_counts=fast_path_counts, debug=debug,
+                                 profile=tracing.is_recording()):
+            if result.output:
+                with tracing.span("output", "output", file=result.check.filename):
+                    for line in result.output:
+                        print(line)
+            if result.internal_error:
+                internal_errors += 1
+                continue
+            files_checked += 1
+            if result.failed_hook_index is not None:
+                failures_by_hook[result.failed_hook_index] = failures_by_hook.get(result.failed_hook_index, 0) + 1
+    selector.close()
+    blob_reader.close()
+
+    if cache is not None:
+        with tracing.span("cache flush"):
+            cache.flush()
+
+    if oversized and max_file_size_action != "skip":
+        for filename, size in oversized:
+            print "# Not checking %s: it is %d bytes, over pygithooks.max-file-size (%d)" % (filename, size,
+                                                                                             max_file_size)
+
+    elapsed = time.time() - start_time
+    files_failed = sum(failures_by_hook.values())
+    print "# Audited %d files in %s in %.1fs (%.1f files/s): %d failed" % (files_checked, tree_ish, elapsed,
+                                                                           files_checked / max(elapsed, 1e-6),
+                                                                           files_failed)
+    for hook_index in sorted(failures_by_hook):
+        print "#   %s: %d" % (hooks[hook_index], failures_by_hook[hook_index])
+    if internal_errors:
+        print "#   internal errors: %d" % internal_errors
+    if oversized and max_file_size_action != "skip":
+        print "#   not checked, over pygithooks.max-file-size: %d" % len(oversized)
+    if debug:
+        for hook_index, (decided, tried) in sorted(fast_path_counts.items()):
+            print "Fast path for %s decided %d of %d files" % (hooks[hook_index], decided, tried)
+        print "Read %d blobs (%d bytes) through one git cat-file process" % (blob_reader.blobs_read,
+                                                                             blob_reader.bytes_read)
+        if cache is not None:
+            print "Result cache: %d hits, %d misses" % (cache.hits, cache.misses)
+
+    return int(bool(files_failed or internal_errors))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Writes fixed file contents back to the index, turned on by `pygithooks.autofix`.
+
+However many files were fixed, it takes three git processes: one `git ls-files` to check the
+index entries, one `git fast-import` to store every fixed blob (running at the same time), and
+one `git update-index --index-info` to point every entry at its fixed blob. Writing to the work
+tree adds one `git hash-object` to compare the files with what was staged.
+
+Blob ids all come from git, so they are right for SHA-1 and SHA-256 repositories alike.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+import os
+import tempfile
+
+from util import BackgroundCommand, run_command
+
+
+class FileFix(object):
+    """
+    Fixed contents for one staged file.
+    """
+
+    def __init__(self, filename, object_id, fixed_code):
+        self.filename = filename
+        # the staged blob that was checked
+        self.object_id = object_id
+        self.fixed_code = fixed_code
+
+
+def index_entries(filenames):
+    """
+    A dict of filename -> (mode, object id) for the given files' stage 0 index entries.
+    """
+    command = ["git", "--literal-pathspecs", "ls-files", "--stage", "-z", "--"] + list(filenames)
+    git_out, git_err, git_rc = run_command(command)
+    if git_err or git_rc:
+        raise RuntimeError("git ls-files returned an error", command, git_err)
+    entries = {}
+    for record in git_out.split("\0"):
+        if not record:
+            continue
+        info, tab, filename = record.partition("\t")
+        mode, object_id, stage = info.split()
+        if stage == "0":
+            entries[filename] = (mode, object_id)
+    return entries
+
+
+def wait_for(command):
+    """
+    Wait for a BackgroundCommand. Returns its output; raises RuntimeError if it fails or writes to stderr.
+    """
+    command_out, command_err, return_code = command.wait()
+    if command_err or return_code:
+        raise RuntimeError("command returned an error", command.argv, command_err)
+    return command_out
+
+
+def run_with_input(command, input):
+    """
+    Run command with input on its stdin. Raises RuntimeError if it fails or writes to stderr.
+    """
+    return wait_for(BackgroundCommand(command, input))
+
+
+def start_writing_blobs(codes):
+    """
+    Start storing each of codes as a blob in the object database, with one `git fast-import` stream.
+    Returns (the running BackgroundCommand, the file it exports its marks to); see written_blob_ids.
+    """
+    marks_fd, marks_filename = tempfile.mkstemp(prefix="pygithooks-marks-")
+    os.close(marks_fd)
+    stream = []
+    mark = 0
+    for code in codes:
+        mark += 1
+        stream.append("blob\nmark :%d\ndata %d\n" % (mark, len(code)))
+        stream.append(code)
+        stream.append("\n")
+    stream.append("done\n")
+    command = ["git", "fast-import", "--quiet", "--done", "--export-marks=%s" % marks_filename]
+    return BackgroundCommand(command, "".join(stream)), marks_filename
+
+
+def written_blob_ids(blob_writer, marks_filename, count):
+    """
+    Wait for start_writing_blobs' fast-import, and return the ids git gave its count blobs, in order.
+    Raises RuntimeError if it failed.
+    """
+    try:
+        wait_for(blob_writer)
+        with open(marks_filename) as marks_file:
+            marks = dict(line.split() for line in marks_file if line.strip())
+    finally:
+        try:
+            os.remove(marks_filename)
+        except OSError:
+            pass
+    try:
+        return [marks[":%d" % mark] for mark in range(1, count + 1)]
+    except KeyError, e:
+        raise RuntimeError("git fast-import did not store every blob", blob_writer.argv, "missing mark %s" % e)
+
+
+def work_tree_blob_ids(filenames):
+    """
+    A dict of filename -> the id of the blob its work tree contents would be stored as (without
+    filters, like what hooks check), with one `git hash-object` call. Files that can't be read,
+    or can't be named on a line, are left out.
+    """
+    filenames = [filename for filename in filenames
+                 if os.path.isfile(filename) and "\n" not in filename and not filename.startswith('"')]
+    if not filenames:
+        return {}
+    try:
+        hash_out = run_with_input(["git", "hash-object", "--no-filters", "--stdin-paths"],
+                                  "".join(filename + "\n" for filename in filenames))
+    except RuntimeError:
+        # e.g. a file removed meanwhile; none is overwritten
+        return {}
+    return dict(zip(filenames, hash_out.split()))
+
+
+def update_index(entries):
+    """
+    Point each (mode, object id, filename) entry in the index at its blob, with one `git update-index` call.
+    """
+    records = ["%s %s\t%s\0" % entry for entry in entries]
+    run_with_input(["git", "update-index", "-z", "--index-info"], "".join(records))
+
+
+def apply_fixes(fixes, write_work_tree=False):
+    """
+    Stage the fixed contents of each FileFix. Returns (lines to print, saying what was done, whether
+    every fix was staged).
+
+    A file whose index entry changed since it was checked is left alone (and still fails). With write_work_tree,
+    the fixed contents are also written to the work tree, but only over a file that still matches
+    what was staged, so unstaged edits are never lost.
+    """
+    if not fixes:
+        return [], True
+    output = []
+    # Every fixed blob is written while the index is read; one that ends up unused is harmless.
+    blob_writer, marks_filename = start_writing_blobs(fix.fixed_code for fix in fixes)
+    try:
+        entries = index_entries(fix.filename for fix in fixes)
+    finally:
+        fixed_object_ids = written_blob_ids(blob_writer, marks_filename, len(fixes))
+    applied = []
+    for fix, fixed_object_id in zip(fixes, fixed_object_ids):
+        mode, object_id = entries.get(fix.filename, (None, None))
+        if object_id != fix.object_id:
+            output.append("# Could not fix %s: its staged contents changed while it was checked" % fix.filename)
+        else:
+            applied.append((mode, fix, fixed_object_id))
+
+    all_applied = len(applied) == len(fixes)
+    if not applied:
+        return output, all_applied
+    update_index((mode, fixed_object_id, fix.filename) for mode, fix, fixed_object_id in applied)
+
+    work_tree_ids = {}
+    if write_work_tree:
+        work_tree_ids = work_tree_blob_ids(fix.filename for mode, fix, fixed_object_id in applied)
+    for mode, fix, fixed_object_id in applied:
+        if not write_work_tree:
+            output.append("# Fixed %s in the index; the work tree still has the unfixed version" % fix.filename)
+            continue
+        unchanged = work_tree_ids.get(fix.filename) == fix.object_id
+        try:
+            if unchanged:
+                with open(fix.filename, "wb") as work_tree_file:
+                    work_tree_file.write(fix.fixed_code)
+        except EnvironmentError:
+            unchanged = False
+        if unchanged:
+            output.append("# Fixed %s in the index and the work tree" % fix.filename)
+        else:
+            output.append("# Fixed %s in the index; the work tree has other changes, so it was left alone" %
+                          fix.filename)
+    return output, all_applied
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Streaming access to git objects.
+
+All object contents for a run are fetched through a single long-lived `git cat-file --batch`
+process, instead of starting one `git show` process per file.
+"""
+
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+import tracing
+from util import kill_process
+
+
+class BlobReader(object):
+    """
+    Reads objects through one `git cat-file --batch` process.
+
+    Object names are anything `git cat-file` accepts, e.g. ":path/in/index" or a full object id.
+    """
+
+    argv = ["git", "cat-file", "--batch"]
+
+    def __init__(self):
+        self.process = None
+        self.started_at = None
+        self.processes_started = 0
+        self.blobs_read = 0
+        self.bytes_read = 0
+
+    def __str__(self):
+        return "<BlobReader: %d blobs, %d bytes, %d processes saved>" % (self.blobs_read, self.bytes_read,
+                                                                         self.processes_saved)
+
+    @property
+    def processes_saved(self):
+        """
+        Number of processes not started, compared to running one `git show` per object.
+        """
+        return max(self.blobs_read - self.processes_started, 0)
+
+    def _start(self):
+        if self.process is None:
+            self.process = subprocess.Popen(self.argv,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+            self.processes_started += 1
+            self.started_at = time.time(), tracing.cpu_time()
+        return self.process
+
+    def _read_header(self, object_name):
+        """
+        Read the header line of one response from cat-file. Returns (object_id, size), or None if the object is missing.
+        """
+        header = self.process.stdout.readline()
+        if not header:
+            raise RuntimeError("git cat-file exited unexpectedly", object_name)
+
+        fields = header.split()
+        if fields[-1] in ("missing", "ambiguous"):
+            return None
+
+        object_id, unused_object_type, size = fields
+        return object_id, int(size)
+
+    def _read_response(self, object_name):
+        """
+        Read one response from cat-file. Returns (object_id, content), or None if the object is missing.
+        """
+        header = self._read_header(object_name)
+        if header is None:
+            return None
+
+        object_id, size = header
+        stdout = self.process.stdout
+        content = stdout.read(size)
+        stdout.read(1)  # trailing LF after every object
+        if len(content) != size:
+            raise RuntimeError("git cat-file returned a truncated object", object_name)
+
+        self.blobs_read += 1
+        self.bytes_read += size
+        return object_id, content
+
+    def read_blob(self, object_name):
+        """
+        Return (object_id, content) for a single object, or None if it does not exist.
+        """
+        if "\n" in object_name:
+            return None
+        process = self._start()
+        process.stdin.write(object_name + "\n")
+        process.stdin.flush()
+        return self._read_response(object_name)
+
+    def read_blobs(self, items, object_name=None):
+        """
+        Generate (item, object_id, content) for each of items, in order.
+
+        items: object names, or anything object_name(item) turns into one; may be a lazy iterable
+        object_id and content are None for missing objects.
+
+        Requests are written to cat-file from a helper thread as items arrive, so git keeps
+        producing output while the caller works on earlier objects.
+        """
+        if object_name is None:
+            def object_name(item):
+                return item
+
+        process = self._start()
+        # items whose requests have been written, in order; None marks the end
+        requested = Queue.Queue()
+        # an exception from iterating items, raised again to our caller
+        item_errors = []
+
+        def write_requests():
+            try:
+                try:
+                    for item in items:
+                        name = object_name(item)
+                        # cat-file reads one name per line; a name with a newline can never be found,
+                        # and an empty line still gets a " missing" response, keeping us in step.
+                        process.stdin.write((name if "\n" not in name else "") + "\n")
+                        process.stdin.flush()
+                        requested.put((item,))
+                except IOError:
+                    # cat-file went away; the reader side reports it.
+                    pass
+                except Exception:
+                    item_errors.append(sys.exc_info())
+            finally:
+                requested.put(None)
+
+        writer = threading.Thread(target=write_requests)
+        writer.setDaemon(True)
+        writer.start()
+
+        while True:
+            entry = requested.get()
+            if entry is None:
+                break
+            item = entry[0]
+            response = self._read_response(object_name(item))
+            if response is None:
+                yield item, None, None
+            else:
+                yield (item,) + response
+
+        writer.join()
+        if item_errors:
+            error_type, error, error_traceback = item_errors[0]
+            raise error_type, error, error_traceback
+
+    def abort(self):
+        """
+        Stop cat-file without reading the responses still due, when the caller gave up on them.
+        """
+        if self.process is not None:
+            kill_process(self.process)
+            self.process.wait()
+            self.process = None
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+            start, cpu_start = self.started_at
+            tracing.record(" ".join(self.argv[:2]), "subprocess", start, time.time(), cpu_start, tracing.cpu_time(),
+                           argv=self.argv, blobs=self.blobs_read)
+
+
+class BlobSizeReader(BlobReader):
+    """
+    Reads object sizes, without their contents, through one `git cat-file --batch-check` process.
+
+    Its read_blob and read_blobs give (object_id, size) where BlobReader's give (object_id, content).
+    """
+
+    argv = ["git", "cat-file", "--batch-check"]
+
+    def _read_response(self, object_name):
+        header = self._read_header(object_name)
+        if header is not None:
+            self.blobs_read += 1
+        return header
+
+
+class BlobPrefixReader(BlobReader):
+    """
+    Reads the first bytes of objects through one `git cat-file --batch` process, e.g. to look for
+    a shebang line. The rest of each object is skipped as it arrives, never kept.
+
+    Its read_blob and read_blobs give (object_id, prefix) where BlobReader's give (object_id, content).
+    """
+
+    # bytes kept from the start of each object
+    prefix_size = 256
+
+    def _read_response(self, object_name):
+        header = self._read_header(object_name)
+        if header is None:
+            return None
+
+        object_id, size = header
+        stdout = self.process.stdout
+        prefix = stdout.read(min(size, self.prefix_size))
+        remaining = size - len(prefix)
+        while remaining > 0:
+            skipped = len(stdout.read(min(remaining, 65536)))
+            if not skipped:
+                break
+            remaining -= skipped
+        stdout.read(1)  # trailing LF after every object
+        if remaining or len(prefix) != min(size, self.prefix_size):
+            raise RuntimeError("git cat-file returned a truncated object", object_name)
+
+        self.blobs_read += 1
+        self.bytes_read += len(prefix)
+        return object_id, prefix
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Which lines of each staged file were added or modified, from one zero-context diff.
+
+Used by the `incremental = lines` mode, which only reports problems on those lines.
+"""
+
+import bisect
+import re
+
+from util import BackgroundCommand
+
+
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+C_ESCAPES = {"a": "\a", "b": "\b", "t": "\t", "n": "\n", "v": "\v", "f": "\f", "r": "\r", '"': '"', "\\": "\\"}
+
+
+class LineRanges(object):
+    """
+    A set of 1-based line numbers, stored as sorted, inclusive (first, last) ranges.
+
+    >>> ranges = LineRanges([(3, 4), (10, 10)])
+    >>> [n for n in range(12) if n in ranges]
+    [3, 4, 10]
+    """
+
+    def __init__(self, ranges=()):
+        self.ranges = sorted(ranges)
+        self.firsts = [first for first, unused_last in self.ranges]
+
+    def __contains__(self, line_number):
+        index = bisect.bisect_right(self.firsts, line_number) - 1
+        return index >= 0 and line_number <= self.ranges[index][1]
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    def __repr__(self):
+        return "LineRanges(%r)" % (self.ranges,)
+
+
+def unquote_path(path):
+    """
+    Undo git's C-style quoting of unusual paths in diff headers.
+
+    >>> unquote_path('"p\\\\303\\\\244th\\\\twith tab"')
+    'p\\xc3\\xa4th\\twith tab'
+    >>> unquote_path('plain path')
+    'plain path'
+    """
+    if not (len(path) >= 2 and path.startswith('"') and path.endswith('"')):
+        return path
+    quoted = path[1:-1]
+    chars = []
+    index = 0
+    while index < len(quoted):
+        char = quoted[index]
+        if char == "\\" and index + 1 < len(quoted):
+            escaped = quoted[index + 1]
+            if escaped in "01234567":
+                chars.append(chr(int(quoted[index + 1:index + 4], 8)))
+                index += 4
+                continue
+            chars.append(C_ESCAPES.get(escaped, escaped))
+            index += 2
+            continue
+        chars.append(char)
+        index += 1
+    return "".join(chars)
+
+
+def parse_changed_lines(diff_lines):
+    """
+    Parse a `git diff -U0` (with b/ destination prefix) into a dict of path -> LineRanges
+    of lines added or modified in the new version.
+
+    >>> diff = ["diff --git a/a.py b/a.py", "+++ b/a.py", "@@ -1,0 +2,3 @@", "+x", "+++ y", "+z", "@@ -9 +12 @@", "+w"]
+    >>> parse_changed_lines(diff)
+    {'a.py': LineRanges([(2, 4), (12, 12)])}
+    """
+    changed = {}
+    ranges = None
+    in_header = False
+    for line in diff_lines:
+        if line.startswith("diff "):
+            in_header = True
+            ranges = None
+        elif in_header and line.startswith("+++ "):
+            # git adds a tab after names containing spaces
+            path = unquote_path(line[4:].rstrip("\t"))
+            if path.startswith("b/"):
+                ranges = changed[path[2:]] = []
+            else:
+                ranges = None  # /dev/null: deleted
+        elif line.startswith("@@") and ranges is not None:
+            in_header = False
+            match = HUNK_HEADER_RE.match(line)
+            if match:
+                first = int(match.group(1))
+                count = int(match.group(2)) if match.group(2) is not None else 1
+                if count:
+                    ranges.append((first, first + count - 1))
+    return dict((path, LineRanges(path_ranges)) for path, path_ranges in changed.items())
+
+
+def start_staged_changed_lines():
+    """
+    Start the diff for staged_changed_lines in the background, so git computes it while the caller
+    does other work. Returns a function that waits for it and returns staged_changed_lines' result.
+    """
+    git_diff_command = ["git", "diff-index", "--cached", "-p", "-U0", "--no-color", "--no-ext-diff",
+                        "--src-prefix=a/", "--dst-prefix=b/", "HEAD"]
+    command = BackgroundCommand(git_diff_command)
+
+    def changed_lines():
+        git_out, git_err, git_rc = command.wait()
+        if git_err or git_rc:
+            raise RuntimeError("git diff-index returned an error", git_out, git_err)
+        return parse_changed_lines(git_out.split("\n"))
+    return changed_lines
+
+
+def staged_changed_lines():
+    """
+    Returns a dict of path -> LineRanges for every file staged for commit, from one git call.
+
+    Raises RuntimeError if git fails.
+    """
+    return start_staged_changed_lines()()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Runs configured external checkers (flake8, pylint, mypy, ...) as hooks.
+
+Each `pygithooks.checker.<name>.command` is a command that takes file paths and reports each
+problem on a line starting `path:` (usually `path:row:...`). A file it names fails.
+
+Starting such a tool costs far more than checking one small file, so files aren't given to it one
+at a time: batch_checks runs it once on as many files as fit on a command line, several runs at
+once, before the engine gets to them.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+import collections
+import os
+import re
+import shutil
+import tempfile
+
+from result_cache import ResultCache, UncachedMessage, hook_identity
+from source import SourceFile, make_temp_tree, strip_temp_dir
+from util import BackgroundCommand, file_fingerprint, get_config, get_config_subsections, kill_process, split_command
+
+
+# Most files given to one run of a checker, so a large commit still gets several runs to spread
+# over the jobs.
+MAX_BATCH_FILES = 200
+
+# Command line bytes per file beyond its path: the pointer to it, and its temp dir.
+ARGUMENT_OVERHEAD = len(tempfile.gettempdir()) + 32
+
+
+def program_fingerprint(program):
+    """
+    Where program is found on $PATH, and its size and modification time; None if it isn't found.
+    """
+    if os.sep in program:
+        candidates = [program]
+    else:
+        candidates = [os.path.join(directory, program)
+                      for directory in os.environ.get("PATH", os.defpath).split(os.pathsep)]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            program_stat = os.stat(candidate)
+            return (candidate, program_stat.st_size, program_stat.st_mtime)
+    return None
+
+
+def split_paths(value):
+    """
+    The paths in a comma or whitespace separated list.
+
+    >>> split_paths(" setup.cfg, .flake8  tox.ini,")
+    ['setup.cfg', '.flake8', 'tox.ini']
+    """
+    return [path for path in re.split(r"[\s,]+", value or "") if path]
+
+
+def reported_problems(lines, filenames):
+    """
+    Attribute a checker's output lines to the files they start with.
+
+    Returns {filename: [(row or None, line)]} for the filenames that have any.
+
+    >>> reported_problems(["a:b.py:3:1: E1", "a.py:x: E2", "1 problem", "b.py: E3"], ["a.py", "a:b.py"])
+    {'a.py': [(None, 'a.py:x: E2')], 'a:b.py': [(3, 'a:b.py:3:1: E1')]}
+    """
+    filenames = set(filenames)
+    problems = {}
+    for line in lines:
+        # the longest filename that the line starts with, as filenames can have colons
+        filename = None
+        colon = line.find(":")
+        while colon != -1:
+            if line[:colon] in filenames:
+                filename = line[:colon]
+            colon = line.find(":", colon + 1)
+        if filename is None:
+            continue
+        try:
+            row = int(line[len(filename) + 1:].split(":", 1)[0])
+        except ValueError:
+            row = None
+        problems.setdefault(filename, []).append((row, line))
+    return problems
+
+
+class CheckerRun(object):
+    """
+    One run of a checker's command on temp copies of some files, in the background.
+    """
+
+    def __init__(self, checker, sources):
+        self.checker = checker
+        self.sources = sources
+        self.temp_dir = None
+        self.command = None
+        self.error = None
+        try:
+            self.temp_dir = make_temp_tree(sources)
+            # absolute paths, so the command can run from the top of the work tree and find its config there
+            self.command = BackgroundCommand(checker.argv + [os.path.join(self.temp_dir, source.filename)
+                                                             for source in sources])
+        except EnvironmentError, e:
+            self.error = str(e)
+
+    def discard(self):
+        """
+        Stop the run and clean up, for results no longer wanted.
+        """
+        if self.command is not None:
+            kill_process(self.command.process)
+            self.command.wait()
+        self._remove_temp_dir()
+
+    def _remove_temp_dir(self):
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, True)
+            self.temp_dir = None
+
+    def results(self):
+        """
+        Wait for the run; returns {filename: (passes, error_message)} with each of its files.
+        """
+        name = self.checker.name
+        temp_dir = self.temp_dir
+        try:
+            if self.command is not None:
+                command_out, command_err, command_rc = self.command.wait()
+        finally:
+            self._remove_temp_dir()
+        # internal errors aren't cached, so the files are checked again once the checker works
+        if self.error is not None:
+            error_message = UncachedMessage("# Internal error running checker %s:\n%s\n" % (name, self.error))
+            return dict((source.filename, (False, error_message)) for source in self.sources)
+
+        lines = strip_temp_dir((command_out + command_err).splitlines(), temp_dir)
+        problems = reported_problems(lines, [source.filename for source in self.sources])
+        if command_rc and not problems:
+            # it failed without naming any file, so it didn't check them
+            error_message = UncachedMessage("# Internal error running checker %s (exit status %d):\n%s\n" %
+                                            (name, command_rc, "\n".join(lines)))
+            return dict((source.filename, (False, error_message)) for source in self.sources)
+
+        results = {}
+        for source in self.sources:
+            source_lines = [line for row, line in problems.get(source.filename, ())
+                            if source.changed_lines is None or row is None or row in source.changed_lines]
+            if source_lines:
+                error_message = "# %s problems with %s:" % (name, source.filename)
+                results[source.filename] = (False, error_message + "\n" + "\n".join(["#   " + line
+                                                                                     for line in source_lines]))
+            else:
+                results[source.filename] = (True, None)
+        return results
+
+
+class ExternalChecker(object):
+
+    # bump when a change could alter results, to invalidate cached results
+    version = "1"
+
+    def __init__(self, name, command, exclude=None, batch=True, config_files=()):
+        self.name = name
+        self.command = command
+        self.argv = split_command(command)
+        self.exclude = exclude
+        self.exclude_re = re.compile(exclude) if exclude else None
+        # whether to run it on many files at once (see batch_checks)
+        self.batch = batch
+        # files, relative to the top of the work tree, whose contents can change its results
+        self.config_files = list(config_files)
+        # its own cost and failure history (see hook_stats)
+        self.stats_name = "%s.%s" % (self.__class__.__name__, name)
+
+    def settings(self):
+        # the name is in its messages; a different version of the program, or different
+        # configuration, can report different problems
+        return (self.name, self.command, program_fingerprint(self.argv[0]),
+                [(filename, file_fingerprint(filename)) for filename in self.config_files])
+
+    def should_process_file(self, filename):
+        if self.exclude_re:
+            return not self.exclude_re.match(filename)
+        return True
+
+    def __str__(self):
+        return "<Checker %s: %s>" % (self.name, self.command)
+
+    def start(self, sources):
+        """
+        Start checking sources, which must have distinct filenames, in one run of the command.
+        """
+        return CheckerRun(self, sources)
+
+    def source_passes(self, source):
+        return self.start([source]).results()[source.filename]
+
+
+def configured_checkers():
+    """
+    An ExternalChecker for each pygithooks.checker.<name> that has a command, by name.
+    """
+    checkers = []
+    for name in get_config_subsections("checker"):
+        command = get_config("checker.%s.command" % name)
+        if not command:
+            continue
+        checkers.append(ExternalChecker(name, command,
+                                        exclude=get_config("checker.%s.exclude" % name),
+                                        batch=get_config("checker.%s.batch" % name, as_bool=True, default=True),
+                                        config_files=split_paths(get_config("checker.%s.config-files" % name))))
+    return checkers
+
+
+def command_line_budget(argvs):
+    """
+    Bytes of arguments that can be added to each of argvs and still fit on a command line.
+    """
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        # Windows' limit, the lowest around
+        arg_max = 32767
+    environment_size = sum(len(key) + len(value) + 2 + 8 for key, value in os.environ.items())
+    longest_argv = max([sum(len(arg) + 1 + 8 for arg in argv) for argv in argvs] + [0])
+    # some room for what differs between systems (e.g. the program's own path)
+    return max(arg_max - environment_size - longest_argv - 4096, 4096)
+
+
+def check_chunks(checks, max_files=MAX_BATCH_FILES, max_bytes=None):
+    """
+    Group checks into lists of at most max_files checks, with distinct filenames, whose temp
+    copies' paths add up to at most max_bytes of command line.
+
+    >>> from engine import FileCheck
+    >>> checks = [FileCheck(name, "", []) for name in ["a.py", "b.py", "a.py", "c.py", "d.py"]]
+    >>> [[check.filename for check in chunk] for chunk in check_chunks(checks, max_files=3)]
+    [['a.py', 'b.py'], ['a.py', 'c.py', 'd.py']]
+    """
+    chunk, chunk_filenames, chunk_bytes = [], set(), 0
+    for check in checks:
+        check_bytes = len(check.filename or "") + ARGUMENT_OVERHEAD
+        if chunk and (len(chunk) >= max_files or check.filename in chunk_filenames or
+                      (max_bytes is not None and chunk_bytes + check_bytes > max_bytes)):
+            yield chunk
+            chunk, chunk_filenames, chunk_bytes = [], set(), 0
+        chunk.append(check)
+        chunk_filenames.add(check.filename)
+        chunk_bytes += check_bytes
+    if chunk:
+        yield chunk
+
+
+def batch_checks(checks, hooks, jobs=1, cache=None):
+    """
+    Pass checks through, after running each batch checker among hooks on them a chunk at a time
+    (see check_chunks), up to jobs chunks at once. Each check gets its batch results in
+    known_results, and comes out, in order, once its chunk is done.
+
+    Files whose results are cached, or that duplicate an earlier file, are left to the engine.
+    Returns checks unchanged if no hook runs in batches.
+    """
+    batch_indexes = [hook_index for hook_index, hook in enumerate(hooks) if getattr(hook, "batch", False)]
+    if not batch_indexes:
+        return checks
+    return _batch_checks(checks, hooks, batch_indexes, max(jobs, 1), cache)
+
+
+def _batch_checks(checks, hooks, batch_indexes, jobs, cache):
+    # its own connection: this runs in whichever thread feeds the engine
+    lookup_cache = ResultCache(cache.filename) if cache is not None else None
+    identities = dict((hook_index, hook_identity(hooks[hook_index])) for hook_index in batch_indexes)
+    max_bytes = command_line_budget([hooks[hook_index].argv for hook_index in batch_indexes])
+    duplicate_keys = set()
+
+    def is_cached(check, hook_index):
+        identity = identities[hook_index]
+        if lookup_cache is None or identity is None or check.object_id is None:
+            return False
+        if check.changed_lines is not None:
+            identity += repr(check.changed_lines)
+        return lookup_cache.get(lookup_cache.key(check.object_id, identity), check.filename) is not None
+
+    def start_runs(chunk):
+        sources = dict((hook_index, []) for hook_index in batch_indexes)
+        for check in chunk:
+            if check.error is not None or check.code is None:
+                continue
+            if check.duplicate_key is not None:
+                if check.duplicate_key in duplicate_keys:
+                    continue
+                duplicate_keys.add(check.duplicate_key)
+            source = SourceFile(check.code, check.filename, check.changed_lines, check.object_id)
+            for hook_index in batch_indexes:
+                if hook_index in check.hook_indexes and not is_cached(check, hook_index):
+                    sources[hook_index].append(source)
+        return [(hook_index, hooks[hook_index].start(sources[hook_index]))
+                for hook_index in batch_indexes if sources[hook_index]]
+
+    def finish_runs(chunk, runs):
+        for hook_index, run in runs:
+            results = run.results()
+            for check in chunk:
+                if check.filename in results and check.code is not None:
+                    check.known_results[hook_index] = results[check.filename]
+        return chunk
+
+    running = collections.deque()
+    try:
+        for chunk in check_chunks(checks, max_bytes=max_bytes):
+            running.append((chunk, start_runs(chunk)))
+            if len(running) >= jobs:
+                for check in finish_runs(*running.popleft()):
+                    yield check
+        while running:
+            for check in finish_runs(*running.popleft()):
+                yield check
+    finally:
+        # e.g. stopped at the first failure
+        for chunk, runs in running:
+            for hook_index, run in runs:
+                run.discard()
@@ -6,18 +6,93 @@ Distinct from check_pep8 because this can actually propose fixes, instead of jus
 """
 
 from __future__ import with_statement   # Python 2.5 compatibility.
-import difflib
+import itertools
 import os
+import re
 try:
-    import CStringIO as StringIO
+    import cStringIO as StringIO
 except ImportError:
     import StringIO
 import sys
 import textwrap
+import tokenize
 
 import reindent
 
 
+# What matters for finding where statements start: strings and comments (skipped whole),
+# brackets, backslash continuations, and newlines with the next line's indentation.
+STATEMENT_SCAN_RE = re.compile(r"""
+      [uUbB]?[rR]?(?:'''(?:[^'\\]|\\.|'(?!''))*'''
+                   |\"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"
+                   |'(?:[^'\\\n]|\\.)*'
+                   |"(?:[^"\\\n]|\\.)*")
+    | \#[^\n]*
+    | [([{]
+    | [)\]}]
+    | \\\n
+    | \n[ ]*
+""", re.DOTALL | re.VERBOSE)
+
+TRAILING_WHITESPACE_RE = re.compile(r"[ \t]\n")
+
+
+def statement_indentations(code):
+    """
+    Generate the indentation of each line that starts a statement, like the first tokens after
+    tokenize's NEWLINE, INDENT and DEDENT tokens.
+
+    Only right for code that parses and contains no tabs, form feeds or carriage returns.
+
+    >>> list(statement_indentations("if x:  # (\\n    y = [1,\\n  2]\\n\\n    # z\\n    s = '''\\n'''\\n"))
+    [0, 4, 4]
+    """
+    depth = 0
+    for match in STATEMENT_SCAN_RE.finditer("\n" + code):
+        text = match.group()
+        first = text[0]
+        if first == "\n":
+            if depth == 0:
+                next_char = code[match.end() - 1:match.end()]
+                # not a blank line, a comment line or the end
+                if next_char and next_char not in "\n#":
+                    yield len(text) - 1
+        elif first in "([{":
+            depth += 1
+        elif first in ")]}":
+            depth -= 1
+
+
+def is_reindented(source):
+    """
+    True if reindent surely wouldn't change source, a SourceFile, without tokenizing it; None if
+    that can't be told quickly.
+
+    Reindent changes nothing if every line is already clean (no tabs, no trailing whitespace, a
+    final newline, no trailing blank lines) and every statement is indented by four spaces per
+    level, since comments are then mapped to their own indentation too.
+    """
+    code = source.code
+    if not code:
+        return True
+    if ("\t" in code or "\f" in code or "\r" in code or not code.endswith("\n") or
+            TRAILING_WHITESPACE_RE.search(code)):
+        return None
+    last_line = code[code.rfind("\n", 0, -1) + 1:]
+    if not last_line.strip() or not source.parses:
+        return None
+    indentations = [0]
+    for indentation in statement_indentations(code):
+        if indentation > indentations[-1]:
+            if indentation != indentations[-1] + 4:
+                return None
+            indentations.append(indentation)
+        else:
+            while indentation < indentations[-1]:
+                indentations.pop()
+    return True
+
+
 def clean_diff_line_for_python_bug_2142(diff_line):
     if diff_line.endswith("\n"):
         return diff_line
@@ -25,50 +100,199 @@ def clean_diff_line_for_python_bug_2142(diff_line):
         return diff_line + "\n\\ No newline at end of file\n"
 
 
-def get_correct_indentation_diff(code, filename):
+def format_range(first, count):
+    """
+    A hunk header range, formatted like difflib.unified_diff does.
+
+    >>> format_range(3, 1), format_range(3, 4), format_range(3, 0)
+    ('3', '3,4', '2,0')
+    """
+    if count == 1:
+        return "%d" % first
+    if not count:
+        # empty ranges begin at the line just before them
+        first -= 1
+    return "%d,%d" % (first, count)
+
+
+def changed_blocks(reindenter):
+    """
+    Generate [first, last, new lines] for each run of consecutive lines the reindenter changes.
+    """
+    block = None
+    for lineno, new_line in reindenter.changes():
+        if block is not None and lineno == block[1] + 1:
+            block[1] = lineno
+            block[2].append(new_line)
+        else:
+            if block is not None:
+                yield block
+            block = [lineno, lineno, [new_line]]
+    if block is not None:
+        yield block
+
+
+def indentation_hunks(reindenter, changed_lines=None, context=3):
+    """
+    Generate the hunks of the reindenter's changes, each a list of changed blocks (see changed_blocks),
+    grouped like difflib.unified_diff groups them.
+
+    changed_lines: if given, a changed_lines.LineRanges; only hunks changing one of those lines are included
+    """
+    def touches(blocks):
+        for first, last, new_lines in blocks:
+            for lineno in xrange(first, last + 1):
+                if lineno in changed_lines:
+                    return True
+        return False
+
+    hunk = []
+    for block in itertools.chain(changed_blocks(reindenter), [None]):
+        # blocks with few enough unchanged lines between them share a hunk
+        if block is not None and hunk and block[0] - hunk[-1][1] - 1 <= 2 * context:
+            hunk.append(block)
+            continue
+        if hunk and (changed_lines is None or touches(hunk)):
+            yield hunk
+        hunk = [block]
+
+
+def indentation_diff_lines(raw_lines, reindenter, filename, changed_lines=None, context=3):
+    """
+    Generate the lines of a unified diff from raw_lines to the reindenter's output.
+
+    raw_lines: the file's lines, as passed to the Reindenter (split only on "\\n")
+    reindenter: a reindent.Reindenter that has been run on them
+    changed_lines: if given, a changed_lines.LineRanges; only hunks changing one of those lines are included
+
+    Reindent changes lines in place and drops trailing blank lines, so line n of its output is line n
+    of the input. The diff is built in one pass over the lines it changes (see Reindenter.changes),
+    with hunks grouped like difflib.unified_diff groups them, but with no matching of lines.
+    """
+    from_count = reindenter.raw_count
+    to_count = len(reindenter.lines) - 1
+    header_done = False
+
+    def hunk_lines(blocks):
+        start = max(1, blocks[0][0] - context)
+        end = min(from_count, blocks[-1][1] + context)
+        yield "@@ -%s +%s @@\n" % (format_range(start, end - start + 1),
+                                   format_range(start, max(min(end, to_count) - start + 1, 0)))
+        lineno = start
+        for first, last, new_lines in blocks:
+            for index in xrange(lineno, first):
+                yield " " + raw_lines[index - 1]
+            for index in xrange(first, last + 1):
+                yield "-" + raw_lines[index - 1]
+            for new_line in new_lines:
+                if new_line is not None:
+                    yield "+" + new_line
+            lineno = last + 1
+        for index in xrange(lineno, end + 1):
+            yield " " + raw_lines[index - 1]
+
+    for hunk in indentation_hunks(reindenter, changed_lines, context):
+        if not header_done:
+            yield "--- %s\n" % filename
+            yield "+++ %s (reindented)\n" % filename
+            header_done = True
+        for line in hunk_lines(hunk):
+            # work around http://bugs.python.org/issue2142
+            yield clean_diff_line_for_python_bug_2142(line)
+
+
+def reindented_code(raw_lines, reindenter, changed_lines=None):
+    """
+    The code with the reindenter's changes applied: all of them, or, if changed_lines is given, only
+    the hunks that indentation_diff_lines would show for it.
+    """
+    fixed_lines = []
+    copied = 0
+    for hunk in indentation_hunks(reindenter, changed_lines):
+        for first, last, new_lines in hunk:
+            fixed_lines.extend(raw_lines[copied:first - 1])
+            fixed_lines.extend(new_line for new_line in new_lines if new_line is not None)
+            copied = last
+    fixed_lines.extend(raw_lines[copied:])
+    return "".join(fixed_lines)
+
+
+def run_reindenter(code, source=None):
+    """
+    A reindent.Reindenter run on code, reusing source's tokens when possible. Returns (reindenter, changed).
+    """
+    reindenter = reindent.Reindenter(StringIO.StringIO(code))
+    if source is not None and reindenter.can_reuse_tokens():
+        changed = reindenter.run(source.generate_tokens())
+    else:
+        changed = reindenter.run()
+    return reindenter, changed
+
+
+def get_correct_indentation_diff(code, filename, source=None):
     """
     Generate a diff to make code correctly indented.
 
     Code: a string containing a file's worth of Python code
     Filename: a filename for the code (used in diff generation)
+    Source: optionally, a SourceFile for code, whose tokens are reused when possible and whose
+        changed_lines, if set, limit the diff to hunks that change those lines
 
     Returns a unified diff to make code correctly indented or None if code is already correctedly indented.
     """
-    code_buffer = StringIO.StringIO(code)
-    output_buffer = StringIO.StringIO()
-    reindenter = reindent.Reindenter(code_buffer)
-    reindenter.run()
-    reindenter.write(output_buffer)
-    reindent_output = output_buffer.getvalue()
-    output_buffer.close()
-    if code != reindent_output:
-        diff_generator = difflib.unified_diff(code.splitlines(True),
-                                              reindent_output.splitlines(True),
-                                              fromfile=filename,
-                                              tofile=filename + " (reindented)")
-        # work around http://bugs.python.org/issue2142
-        diff = "".join(clean_diff_line_for_python_bug_2142(diff_line) for diff_line in diff_generator)
-        return diff
-    else:
+    reindenter, changed = run_reindenter(code, source)
+    if not changed:
         return None
 
+    if source is not None:
+        raw_lines = source.lines
+        changed_lines = source.changed_lines
+    else:
+        raw_lines = StringIO.StringIO(code).readlines()
+        changed_lines = None
+    return "".join(indentation_diff_lines(raw_lines, reindenter, filename, changed_lines)) or None
+
 
 class CheckIndentation(object):
 
+    # bump when a change could alter results, to invalidate cached results
+    version = "2"
+
+    # checks every Python file (see selection.FileSelector)
+    exclude = None
+
     def should_process_file(self, filename):
         return True
 
+    def settings(self):
+        return (reindent.__version__,)
+
     def __str__(self):
         return "<CheckIndentation>"
 
-    def file_passes(self, temp_filename, original_filename=None):
-        if original_filename is None:
-            original_filename = temp_filename
+    def fast_path(self, source):
+        """
+        True if the file surely passes, without tokenizing it (see is_reindented).
+        """
+        return is_reindented(source)
+
+    def fix(self, source):
+        """
+        The source's code with its indentation fixed, or None if it can't be fixed.
 
-        with open(temp_filename, "r") as temp_file:
-            code = temp_file.read()
+        With source.changed_lines set, only the hunks its failure message shows are fixed.
+        """
+        try:
+            reindenter, changed = run_reindenter(source.code, source)
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            return None
+        if not changed:
+            return None
+        return reindented_code(source.lines, reindenter, source.changed_lines)
 
-        diff = get_correct_indentation_diff(code, original_filename)
+    def source_passes(self, source):
+        original_filename = source.filename
+        diff = get_correct_indentation_diff(source.code, original_filename, source)
         if diff:
             error_message = textwrap.dedent("""
                                             # %(f)s has indentation problems. To fix them automatically,
@@ -1,21 +1,132 @@
 #!/usr/bin/env python
 """
 Checks code for PEP8 compliance.
+
+The bundled pep8.py is imported once per process and run on in-memory source, rather than
+started as a separate interpreter for every file. It reads the same configuration files as its
+command line did on a temp copy of the file (see pep8_config_files).
 """
 
+from __future__ import with_statement   # Python 2.5 compatibility.
+import imp
 import os
 import re
+import tempfile
+import traceback
+
+from source import strip_temp_dir
+from util import file_fingerprint, get_config, run_command
+
+
+PEP8_PATH = os.path.join(os.path.dirname(__file__), "pep8", "pep8.py")
+
+# Same as pep8's default --format.
+PEP8_FORMAT = "%(path)s:%(row)d:%(col)d: %(code)s %(text)s"
+
+_pep8_module = None
+_pep8_style_guides = {}
+
+
+def load_pep8():
+    """
+    Import the bundled pep8.py, once per process.
+
+    Returns None if it can't be used in-process (it's missing, or too old to have pep8's
+    StyleGuide API), in which case pep8 is run as a command instead.
+    """
+    global _pep8_module
+    if _pep8_module is None:
+        try:
+            _pep8_module = imp.load_source("pygithooks_pep8", PEP8_PATH)
+        except (ImportError, IOError, SyntaxError):
+            _pep8_module = False
+        if _pep8_module and not (hasattr(_pep8_module, "StyleGuide") and hasattr(_pep8_module, "BaseReport")):
+            _pep8_module = False
+    return _pep8_module or None
+
+
+def pep8_config_files():
+    """
+    The files pep8.py reads its configuration from when run on a temp copy of a file: the user's
+    (~/.config/pep8), and any setup.cfg, tox.ini or .pep8 in the temp dir or above it.
+    """
+    pep8 = load_pep8()
+    if pep8 is None:
+        return []
+    config_files = []
+    if pep8.USER_CONFIG:
+        config_files.append(pep8.USER_CONFIG)
+    directory = tempfile.gettempdir()
+    while True:
+        config_files += [os.path.join(directory, name) for name in pep8.PROJECT_CONFIG]
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return config_files
+        directory = parent
+
+
+def get_style_guide(pep8_ignore):
+    """
+    A pep8 StyleGuide configured like `pep8.py --ignore=<pep8_ignore> -r <temp copy>`, built once
+    per process.
+    """
+    if pep8_ignore not in _pep8_style_guides:
+        pep8 = load_pep8()
+
+        class CollectingReport(pep8.BaseReport):
+            """
+            Keeps every problem (like -r) instead of printing it.
+            """
+
+            def init_file(self, filename, lines, expected, line_offset):
+                self.problems = []
+                return super(CollectingReport, self).init_file(filename, lines, expected, line_offset)
 
-from util import get_config, run_command
+            def error(self, line_number, offset, text, check):
+                code = super(CollectingReport, self).error(line_number, offset, text, check)
+                if code:
+                    self.problems.append((line_number, offset, code, text[5:]))
+                return code
+
+        # The command line always got --ignore, "None" when unset, which also turns off
+        # pep8's default ignore list; keep doing the same.
+        ignore = str(pep8_ignore).split(",")
+        # paths: where the command line looked for project configuration, above the temp copies
+        _pep8_style_guides[pep8_ignore] = pep8.StyleGuide(paths=[tempfile.gettempdir()], ignore=ignore, repeat=True,
+                                                          reporter=CollectingReport)
+    return _pep8_style_guides[pep8_ignore]
+
+
+def pep8_problems(lines, filename, pep8_ignore):
+    """
+    Run pep8 on a file's lines (split as by readlines()), in this process.
+
+    Returns a sorted list of (row, col, line), where line is formatted as on pep8's command line.
+    """
+    style_guide = get_style_guide(pep8_ignore)
+    # pep8 may modify the lines it's given; keep the caller's intact
+    style_guide.input_file(filename, lines=list(lines))
+    problems = sorted(style_guide.options.report.problems)
+    return [(row, offset + 1, PEP8_FORMAT % dict(path=filename, row=row, col=offset + 1, code=code, text=text))
+            for row, offset, code, text in problems]
 
 
 class CheckPep8(object):
 
+    # bump when a change could alter results, to invalidate cached results
+    version = "2"
+
     def __init__(self):
         self.exclude = get_config("pep8-exclude")
         self.exclude_re = re.compile(self.exclude) if self.exclude else None
         self.pep8_ignore = get_config("pep8-ignore")
 
+    def settings(self):
+        # a different pep8.py, or a change to its configuration, can report different problems
+        return (self.pep8_ignore, file_fingerprint(PEP8_PATH),
+                [(filename, file_fingerprint(filename)) for filename in pep8_config_files()
+                 if os.path.exists(filename)])
+
     def should_process_file(self, filename):
         if self.exclude_re:
             return not self.exclude_re.match(filename)
@@ -24,23 +135,49 @@ class CheckPep8(object):
     def __str__(self):
         return "<CheckPep8: ignore %r, exclude %r>" % (self.pep8_ignore, self.exclude)
 
-    def file_passes(self, temp_filename, original_filename=None):
-        if original_filename is None:
-            original_filename = temp_filename
+    def source_passes(self, source):
+        original_filename = source.filename
+
+        if load_pep8() is None:
+            with source.temp_copy() as temp_filename:
+                return self.file_passes_command(temp_filename, original_filename, source.changed_lines)
+
+        try:
+            problems = pep8_problems(source.lines, original_filename, self.pep8_ignore)
+        except Exception:
+            return False, "# Internal error checking pep8:\n%(pep8_err)s\n" % dict(pep8_err=traceback.format_exc())
 
-        pep8_path = os.path.join(os.path.dirname(__file__), "pep8", "pep8.py")
-        pep8_command = "%(pep8_path)s --ignore=%(ignore)s -r %(filename)s" % dict(pep8_path=pep8_path,
-                                                                                  ignore=self.pep8_ignore,
-                                                                                  filename=temp_filename)
+        pep8_out = [line for row, unused_col, line in problems
+                    if source.changed_lines is None or row in source.changed_lines]
+
+        if pep8_out:
+            error_message = "# pep8 problems with %(f)s:" % dict(f=original_filename)
+            pep8_formatted = "\n".join(["#   " + line for line in pep8_out])
+            return False, error_message + "\n" + pep8_formatted
+
+        return True, None
+
+    def file_passes_command(self, temp_filename, original_filename, changed_lines=None):
+        """
+        Run pep8.py as a separate command; only used when it can't be imported.
+        """
+        # an argument list, so paths with spaces stay whole
+        pep8_command = [PEP8_PATH, "--ignore=%s" % self.pep8_ignore, "-r", temp_filename]
         pep8_out, pep8_err, pep8_rc = run_command(pep8_command)
         if len(pep8_err) > 0:
             return False, "# Internal error checking pep8:\n%(pep8_err)s\n" % dict(pep8_err=pep8_err)
 
-        if len(pep8_out) > 0:
+        pep8_lines = pep8_out.splitlines()
+        if changed_lines is not None:
+            pep8_lines = [line for line in pep8_lines
+                          if not line.startswith(temp_filename + ":") or
+                          int(line[len(temp_filename) + 1:].split(":", 1)[0]) in changed_lines]
+
+        if len(pep8_lines) > 0:
             assert temp_filename.endswith(original_filename)
             temp_dir = temp_filename[:-len(original_filename)]
             error_message = "# pep8 problems with %(f)s:" % dict(f=original_filename)
-            pep8_formatted = "\n".join(["#   " + line.replace(temp_dir, "") for line in pep8_out.splitlines()])
+            pep8_formatted = "\n".join(["#   " + line for line in strip_temp_dir(pep8_lines, temp_dir)])
             return False, error_message + "\n" + pep8_formatted
 
         return True, None
@@ -3,42 +3,95 @@
 Checks code for ambiguous tabs or other basic parsing issues.
 """
 
-from __future__ import with_statement   # Python 2.5 compatibility.
-try:
-    import CStringIO as StringIO
-except ImportError:
-    import StringIO
 import tabnanny
 import tokenize
 
 
+def nanny_nags(tokens):
+    """
+    Generate a tabnanny.NannyNag for every ambiguous indentation in tokens.
+
+    This is tabnanny.process_tokens, except that it carries on after a problem instead of
+    raising it, so callers can look past problems they don't care about.
+    """
+    INDENT = tokenize.INDENT
+    DEDENT = tokenize.DEDENT
+    NEWLINE = tokenize.NEWLINE
+    JUNK = tokenize.COMMENT, tokenize.NL
+    indents = [tabnanny.Whitespace("")]
+    check_equal = 0
+
+    for (token_type, token, start, end, line) in tokens:
+        if token_type == NEWLINE:
+            # a statement or ENDMARKER follows; an INDENT in between undoes this
+            check_equal = 1
+
+        elif token_type == INDENT:
+            check_equal = 0
+            thisguy = tabnanny.Whitespace(token)
+            if not indents[-1].less(thisguy):
+                witness = indents[-1].not_less_witness(thisguy)
+                msg = "indent not greater e.g. " + tabnanny.format_witnesses(witness)
+                yield tabnanny.NannyNag(start[0], msg, line)
+            indents.append(thisguy)
+
+        elif token_type == DEDENT:
+            check_equal = 1
+            del indents[-1]
+
+        elif check_equal and token_type not in JUNK:
+            # the first token of a statement (or ENDMARKER, whose line is ""): its leading
+            # whitespace must match the top of the indents stack
+            check_equal = 0
+            thisguy = tabnanny.Whitespace(line)
+            if not indents[-1].equal(thisguy):
+                witness = indents[-1].not_equal_witness(thisguy)
+                msg = "indent not equal e.g. " + tabnanny.format_witnesses(witness)
+                yield tabnanny.NannyNag(start[0], msg, line)
+
+
 class CheckTabs(object):
 
+    # bump when a change could alter results, to invalidate cached results
+    version = "1"
+
+    # always runs before the other hooks (see hook_stats.hook_order): it reports code that
+    # doesn't tokenize, which reindent and pep8 can't make sense of
+    run_first = True
+
+    # checks every Python file (see selection.FileSelector)
+    exclude = None
+
     def should_process_file(self, filename):
         return True
 
     def __str__(self):
         return "<CheckTabs>"
 
-    def file_passes(self, temp_filename, original_filename=None):
-        if original_filename is None:
-            original_filename = temp_filename
+    def fast_path(self, source):
+        """
+        True if the file surely passes, without tokenizing it.
 
-        with open(temp_filename, "r") as temp_file:
-            code = temp_file.read()
+        Without tabs or form feeds, every line's indentation is the same whatever the tab size,
+        so tabnanny has nothing to complain about, and if the parser accepts the file it
+        tokenizes without errors.
+        """
+        return "\t" not in source.code and "\f" not in source.code and source.parses
 
+    def source_passes(self, source):
+        original_filename = source.filename
         # note that this uses non-public elements from stdlib's tabnanny, because tabnanny
         # is (very frustratingly) written only to be used as a script, but using it that way
         # in this context requires writing temporarily files, running subprocesses, blah blah blah
-        code_buffer = StringIO.StringIO(code)
         try:
-            tabnanny.process_tokens(tokenize.generate_tokens(code_buffer.readline))
+            for e in nanny_nags(source.generate_tokens()):
+                # with changed_lines, only problems on those lines count; files that don't parse always fail
+                if source.changed_lines is None or e.get_lineno() in source.changed_lines:
+                    return False, "# Ambiguous tab in %(f)s at line %(line)s; line is '%(contents)s'." % dict(line=e.get_lineno(),
+                                                                                                              contents=e.get_line().rstrip(),
+                                                                                                              f=original_filename)
         except tokenize.TokenError, e:
             return False, "# Could not parse code in %(f)s: %(e)s" % dict(e=e, f=original_filename)
         except IndentationError, e:
             return False, "# Indentation error in %(f)s: %(e)s" % dict(e=e, f=original_filename)
-        except tabnanny.NannyNag, e:
-            return False, "# Ambiguous tab in %(f)s at line %(line)s; line is '%(contents)s'." % dict(line=e.get_lineno(),
-                                                                                                      contents=e.get_line().rstrip(),
-                                                                                                      f=original_filename)
         return True, None
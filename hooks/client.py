@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+client.py
+
+Thin pre-commit client: has a warm hook server (see server.py) run the hooks, or runs them
+in this process if no server is listening or the server's code is out of date.
+
+Takes the same arguments as precommit.py, and prints and exits the same.
+"""
+
+import errno
+import marshal
+import os
+import socket
+import sys
+
+from util import server_socket_filename, short_path
+
+
+class ServerUnavailable(Exception):
+    """
+    No server could run the request; the caller should run it in-process.
+    """
+
+
+class ServerStopped(ServerUnavailable):
+    """
+    The server went away partway through a request, maybe after sending some of its output.
+    """
+
+
+def write_message(stream, kind, data):
+    """
+    Write a message: a one-letter kind, then data, a string.
+    """
+    stream.write("%s%d\n" % (kind, len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def read_message(stream):
+    """
+    Read a message written by write_message. Returns (kind, data), or (None, None) at end of stream.
+    """
+    header = stream.readline()
+    if not header.endswith("\n"):
+        return None, None
+    kind, length = header[0], int(header[1:])
+    data = stream.read(length)
+    if len(data) != length:
+        return None, None
+    return kind, data
+
+
+def connect(socket_filename):
+    """
+    A socket connected to the server listening on socket_filename. Raises ServerUnavailable if there is none.
+    """
+    if socket_filename is None or not os.path.exists(socket_filename):
+        raise ServerUnavailable("no server socket")
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # socket paths are limited to about 100 bytes; the relative one is usually much shorter
+        connection.connect(short_path(socket_filename))
+    except socket.error, e:
+        connection.close()
+        if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+            # a server that died without removing its socket
+            raise ServerUnavailable("no server listening")
+        raise
+    return connection
+
+
+def request(socket_filename, message, output=None):
+    """
+    Send message, a dict, to the server, writing any output it streams back to output.
+
+    Returns the response data, or raises ServerUnavailable.
+    """
+    connection = connect(socket_filename)
+    try:
+        stream = connection.makefile("rb+", 0)
+        write_message(stream, "r", marshal.dumps(message))
+        while True:
+            kind, data = read_message(stream)
+            if kind == "o" and output is not None:
+                output.write(data)
+                output.flush()
+            elif kind == "x":
+                return data
+            elif kind == "s":
+                raise ServerUnavailable("server is stale: %s" % data)
+            elif kind is None:
+                raise ServerStopped("server stopped unexpectedly")
+    finally:
+        connection.close()
+
+
+def run_on_server(argv):
+    """
+    Run the hooks on the server, streaming their output. Returns the exit status.
+    """
+    message = dict(command="run", argv=argv, cwd=os.getcwd(), env=dict(os.environ))
+    return int(request(server_socket_filename(), message, sys.stdout))
+
+
+def run_in_process(argv):
+    # only imported when no server took the request; this is the slow part of starting up
+    import precommit
+    from util import get_config
+    if get_config("server", as_bool=True, default=False):
+        import server
+        server.start_in_background()
+    return precommit.main(argv)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        return run_on_server(argv)
+    except ServerStopped:
+        print "# Hook server stopped unexpectedly; checking here instead"
+    except ServerUnavailable:
+        pass
+    except socket.error, e:
+        print "# Could not reach the hook server (%s); checking here instead" % e
+    return run_in_process(argv)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+Runs hooks over files, in a pool of worker processes when more than one job is allowed.
+
+Each file is checked independently and stops at its first failing hook. Results come
+back in the order the files were given, so output is the same no matter how many jobs run.
+
+Hooks get each file's contents in memory, as a SourceFile: a hook defines
+source_passes(source), returning (passes, error message or None). Hooks written for the older
+protocol, file_passes(temp_filename, original_filename), still work; they get a temp copy of
+the file (see run_hook).
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None  # Python 2.5; always check serially.
+import hashlib
+import itertools
+import threading
+import time
+
+from hook_stats import stats_name
+from result_cache import UncachedMessage, hook_identity
+from source import SourceFile
+import tracing
+
+
+# Fewer files than this are checked in this process: starting a pool of workers costs more than
+# checking a few files.
+MIN_PARALLEL_CHECKS = 8
+
+
+class FileCheck(object):
+    """
+    The work for one file: which hooks to run on which version of it.
+
+    The contents are dropped once checked (see check_file), so they aren't sent back from
+    worker processes or kept around by the caller.
+    """
+
+    def __init__(self, filename, code, hook_indexes, previous_code=None, error=None,
+                 object_id=None, previous_object_id=None, changed_lines=None, duplicate_key=None):
+        self.filename = filename
+        self.code = code
+        self.hook_indexes = hook_indexes
+        # in incremental mode, the earlier version of the file; hooks it already failed are skipped.
+        self.previous_code = previous_code
+        # set instead of code when the file could not be read; reported as an internal error.
+        self.error = error
+        # blob ids, used as result cache keys
+        self.object_id = object_id
+        self.previous_object_id = previous_object_id
+        # in line-range incremental mode, the LineRanges whose problems are reported
+        self.changed_lines = changed_lines
+        # equal for checks of the same contents with the same hooks and settings; only the first is run (see run_checks)
+        self.duplicate_key = duplicate_key
+        # for a stand-in for a duplicate, sent through the workers only to keep results in order:
+        # the duplicate's number in run_checks' deferred checks; else None
+        self.deferred = None
+        # results already known for code, by hook index (e.g. from a batch run; see check_external);
+        # these hooks aren't run again
+        self.known_results = {}
+
+
+class FileResult(object):
+
+    def __init__(self, check):
+        self.check = check
+        self.failed = False
+        self.failed_hook_index = None
+        self.output = []  # lines to print, in order
+        # result cache activity, applied by the parent process (see ResultCache.record)
+        self.new_cache_results = []
+        self.used_cache_keys = []
+        # with profiling on, spans recorded in a worker process, added to the parent's trace
+        self.trace_events = []
+        # (hook index, whether it decided) for each fast path tried
+        self.fast_paths = []
+        # (hook index, seconds, bytes of source, whether it passed) for each hook run (not for cached results)
+        self.hook_runs = []
+        # with autofix on, the fixed contents that pass every hook
+        self.fixed_code = None
+
+    @property
+    def internal_error(self):
+        return self.check.error is not None
+
+
+# The hooks and run options, set once per worker process (or once in-process for serial runs).
+_hooks = None
+_options = None
+_cache = None
+_hook_identities = None
+_in_worker = False
+
+
+def _init_worker(hooks, options, cache=None, in_worker=False):
+    global _hooks, _options, _cache, _hook_identities, _in_worker
+    _hooks = hooks
+    _options = options
+    _cache = cache
+    _hook_identities = [hook_identity(hook) if cache is not None else None for hook in hooks]
+    _in_worker = in_worker
+    if in_worker and options.get("profile"):
+        tracing.start_recording()
+
+
+def run_hook(hook, source):
+    """
+    Run hook on source, a SourceFile. Returns (passes, error message or None).
+
+    Hooks without source_passes get a temp copy of the file, at the same path under a temp dir.
+    """
+    if hasattr(hook, "source_passes"):
+        return hook.source_passes(source)
+    with source.temp_copy() as temp_filename:
+        return hook.file_passes(temp_filename, original_filename=source.filename)
+
+
+def _run_hook(hook_index, source, result, known_results=None):
+    """
+    Run one hook on one version of a file, going through the result cache when possible.
+
+    The same SourceFile is given to every hook, so each version is tokenized at most once.
+    A result in known_results is used (and cached) instead of running the hook. Results whose
+    error message is an UncachedMessage aren't cached.
+    """
+    key = None
+    filename = source.filename
+    identity = _hook_identities[hook_index]
+    if identity is not None and source.object_id is not None:
+        if source.changed_lines is not None:
+            identity += repr(source.changed_lines)
+        key = _cache.key(source.object_id, identity)
+        with tracing.span(str(_hooks[hook_index]), "cache", file=filename):
+            cached = _cache.get(key, filename)
+        if cached is not None:
+            result.used_cache_keys.append(key)
+            return cached
+
+    if known_results and hook_index in known_results:
+        passes, error_message = known_results[hook_index]
+    else:
+        hook = _hooks[hook_index]
+        start = time.time()
+        with tracing.span(str(hook), "hook", file=filename, object=source.object_id) as span:
+            # Hooks may declare a cheap, sound check that a file passes; the full check runs only when it can't tell.
+            decided = False
+            if hasattr(hook, "fast_path"):
+                decided = bool(hook.fast_path(source))
+                result.fast_paths.append((hook_index, decided))
+                span.args["fast_path"] = decided
+            if decided:
+                passes, error_message = True, None
+            else:
+                passes, error_message = run_hook(hook, source)
+        result.hook_runs.append((hook_index, time.time() - start, len(source.code), passes))
+    if key is not None and not isinstance(error_message, UncachedMessage):
+        result.new_cache_results.append((key, passes, error_message, filename))
+    return passes, error_message
+
+
+def blob_id(code):
+    """
+    The id git gives a blob with contents code in a SHA-1 repository.
+
+    Only used as a result cache key for contents git hasn't stored yet; ids that go into git
+    come from git itself (see autofix), whatever the repository's object format.
+
+    >>> blob_id("")
+    'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+    """
+    return hashlib.sha1("blob %d\0%s" % (len(code), code)).hexdigest()
+
+
+def check_file(check):
+    """
+    Run the hooks for one FileCheck. Returns a FileResult.
+    """
+    result = FileResult(check)
+    if check.deferred is None:
+        _check_file(check, result)
+    check.code = check.previous_code = None
+    if _in_worker:
+        result.trace_events = tracing.take_events()
+    return result
+
+
+def _check_file(check, result):
+    if check.error is not None:
+        result.output.append("# Internal hook error:\n%s\n" % check.error)
+        result.failed = True
+        return
+
+    hook_indexes = check.hook_indexes
+    source = SourceFile(check.code, check.filename, check.changed_lines, check.object_id)
+
+    if check.previous_code is not None:
+        incremental_hook_indexes = list(hook_indexes)
+        previous_source = source
+        if check.previous_object_id is None or check.previous_object_id != check.object_id:
+            previous_source = SourceFile(check.previous_code, check.filename, object_id=check.previous_object_id)
+        # This is not a newly added file, so check whether it used to fail the hooks.
+        for hook_index in hook_indexes:
+            head_passes, unused_error_message = _run_hook(hook_index, previous_source, result)
+            if not head_passes:
+                # Incremental checking was requested, and current HEAD doesn't pass,
+                # so don't bother checking this file with this hook.
+                incremental_hook_indexes.remove(hook_index)
+                if _options.get("incremental_verbose"):
+                    result.output.append("Hook %s failed on current HEAD for file %s" % (_hooks[hook_index],
+                                                                                         check.filename))
+        hook_indexes = incremental_hook_indexes
+
+    if not hook_indexes:
+        if _options.get("debug"):
+            result.output.append("Skipping %s, no relevant hooks (after incremental check)" % check.filename)
+        return
+
+    hook_order = _options.get("hook_order")
+    if hook_order:
+        hook_indexes = sorted(hook_indexes, key=hook_order.index)
+
+    for hook_index in hook_indexes:
+        passes, error_message = _run_hook(hook_index, source, result, check.known_results)
+        if not passes:
+            if _options.get("autofix") and _fix_file(source, result, hook_index, hook_indexes):
+                break
+            result.output.append(error_message)
+            result.failed = True
+            result.failed_hook_index = hook_index
+            break
+
+
+def _fix_file(source, result, hook_index, hook_indexes):
+    """
+    Try to fix source, which failed hook_index, with the hook's fix method if it has one.
+
+    The fix is kept (in result.fixed_code) only if the fixed code passes every hook in
+    hook_indexes, including those the original passed; returns whether it was.
+    """
+    hook = _hooks[hook_index]
+    if not hasattr(hook, "fix"):
+        return False
+    with tracing.span(str(hook), "fix", file=source.filename):
+        fixed_code = hook.fix(source)
+    if fixed_code is None or fixed_code == source.code:
+        return False
+
+    fixed_source = SourceFile(fixed_code, source.filename, source.changed_lines, blob_id(fixed_code))
+    for fixed_hook_index in hook_indexes:
+        passes, unused_error_message = _run_hook(fixed_hook_index, fixed_source, result)
+        if not passes:
+            return False
+    result.fixed_code = fixed_code
+    return True
+
+
+def cpu_count():
+    if multiprocessing is None:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def run_checks(hooks, checks, jobs=1, cache=None, fast_path_counts=None, hook_stats=None, ordered=True, **options):
+    """
+    Generate a FileResult for each FileCheck in checks, in order; or, if not ordered, as soon as
+    each is ready (with several jobs), e.g. to stop at whichever failure is found first.
+
+    checks may be a lazy iterable; with several jobs it is consumed from a helper thread,
+    so it must not raise (report problems through FileCheck.error instead). A commit with only a
+    few files is checked in this process whatever jobs is (see MIN_PARALLEL_CHECKS).
+
+    Workers only read from cache; new results are recorded on it here, to be flushed by the caller.
+
+    fast_path_counts: if given, a dict updated with hook index -> [files decided by the hook's
+        fast path, files it was tried on]
+    hook_stats: if given, a hook_stats.HookStats to record every hook run in
+
+    options.hook_order, if given, lists hook indexes in the order to run them on each file.
+
+    A check with the duplicate_key of an earlier one isn't run: if the earlier file passed quietly,
+    so does this one (with the same fix, if any). Otherwise it is checked here, under its own name,
+    since hook messages name the file.
+    """
+    # duplicate_key -> (filename, passed quietly, fixed code) of the first check with that key
+    first_outcomes = {}
+    # the checks replaced by stand-ins, by the stand-ins' deferred numbers
+    deferred_checks = {}
+    # duplicate_key -> checks whose stand-in came back before the first check with that key did,
+    # which only happens if not ordered
+    waiting_checks = {}
+    checks = _defer_duplicates(checks, deferred_checks)
+    for result in _run_checks(hooks, checks, jobs, cache, options, ordered):
+        key = result.check.duplicate_key
+        if result.check.deferred is not None:
+            check = deferred_checks.pop(result.check.deferred)
+            if key not in first_outcomes:
+                waiting_checks.setdefault(key, []).append(check)
+                continue
+            results = [_check_duplicate(check, first_outcomes[key], hooks, cache, options)]
+        else:
+            results = [result]
+            if key is not None:
+                passed_quietly = not result.failed and not result.output
+                first_outcomes[key] = (result.check.filename, passed_quietly, result.fixed_code)
+                results += [_check_duplicate(check, first_outcomes[key], hooks, cache, options)
+                            for check in waiting_checks.pop(key, ())]
+        for result in results:
+            if cache is not None:
+                cache.record(result.new_cache_results, result.used_cache_keys)
+            if fast_path_counts is not None:
+                for hook_index, decided in result.fast_paths:
+                    counts = fast_path_counts.setdefault(hook_index, [0, 0])
+                    counts[0] += decided
+                    counts[1] += 1
+            if hook_stats is not None:
+                for hook_index, seconds, size, passes in result.hook_runs:
+                    hook_stats.record(stats_name(hooks[hook_index]), seconds, size, failed=not passes)
+            tracing.add_events(result.trace_events)
+            yield result
+
+
+def _defer_duplicates(checks, deferred_checks):
+    """
+    Pass checks through, replacing each duplicate of an earlier check with a stand-in, and
+    adding the duplicate to deferred_checks under the stand-in's deferred number.
+    """
+    keys = set()
+    numbers = itertools.count()
+    for check in checks:
+        key = check.duplicate_key
+        if key is not None and key in keys:
+            stand_in = FileCheck(check.filename, None, [], duplicate_key=key)
+            stand_in.deferred = numbers.next()
+            deferred_checks[stand_in.deferred] = check
+            yield stand_in
+        else:
+            if key is not None:
+                keys.add(key)
+            yield check
+
+
+def _check_duplicate(check, first_outcome, hooks, cache, options):
+    """
+    The result for check, a duplicate of a check with first_outcome (see run_checks).
+    """
+    first_filename, passed_quietly, fixed_code = first_outcome
+    if passed_quietly:
+        result = FileResult(check)
+        if options.get("debug"):
+            result.output.append("%s has the same contents as %s, checked once" % (check.filename, first_filename))
+        result.fixed_code = fixed_code
+        check.code = check.previous_code = None
+        return result
+    # rare, so checked in this process, even when the others go to workers
+    _init_worker(hooks, options, cache)
+    return check_file(check)
+
+
+def _run_checks(hooks, checks, jobs, cache, options, ordered=True):
+    if jobs > 1 and multiprocessing is not None:
+        # look ahead far enough to tell whether a pool, and how large a one, is worth starting
+        checks = iter(checks)
+        first_checks = list(itertools.islice(checks, max(jobs, MIN_PARALLEL_CHECKS)))
+        if len(first_checks) < MIN_PARALLEL_CHECKS:
+            jobs = 1
+        else:
+            jobs = min(jobs, len(first_checks))
+        checks = itertools.chain(first_checks, checks)
+
+    if jobs > 1 and multiprocessing is not None:
+        # The pool would otherwise read checks as fast as it can; keep a bounded number of
+        # files in flight so huge lazy runs (like auditing a whole tree) stay small in memory.
+        in_flight = threading.Semaphore(jobs * 4)
+        # set if the caller stopped early, so the feeder stops instead of waiting for room
+        aborted = threading.Event()
+
+        def bounded(checks):
+            for check in checks:
+                in_flight.acquire()
+                if aborted.isSet():
+                    return
+                yield check
+
+        pool = multiprocessing.Pool(jobs, _init_worker, (hooks, options, cache, True))
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for result in imap(check_file, bounded(checks)):
+                in_flight.release()
+                yield result
+            pool.close()
+        finally:
+            # still running if the caller stopped early; terminate waits for the pool's thread
+            # that runs bounded, which may be waiting for room
+            aborted.set()
+            in_flight.release()
+            pool.terminate()
+            pool.join()
+    else:
+        _init_worker(hooks, options, cache)
+        for check in checks:
+            yield check_file(check)
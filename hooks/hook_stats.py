@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Each hook's recorded cost and failure rate, used by `pygithooks.fail-fast` to order the hooks.
+
+Every fail-fast run adds the time each hook took (per KB of source) and whether it failed. The history
+lives in `.git/pygithooks/hook-stats.json`, and is scaled down now and then so it follows
+recent commits. With it, the hook expected to find a problem for the least time runs first.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+try:
+    import json
+except ImportError:
+    json = None  # Python 2.5; no history is kept, and hooks keep their configured order.
+import os
+
+from util import get_git_dir, write_file_atomically
+
+
+# Once a hook has this many runs recorded, its history is halved, so old commits count for less.
+MAX_RUNS = 1000
+
+
+class HookStats(object):
+    """
+    Per-hook totals: runs, failures, seconds and KB of source checked.
+
+    >>> stats = HookStats()
+    >>> for unused in range(10):
+    ...     stats.record("Slow", 0.5, 1024, failed=False)
+    ...     stats.record("Fast", 0.01, 1024, failed=False)
+    >>> stats.ranked(["Slow", "Fast"])
+    [1, 0]
+    >>> stats.ranked(["Slow", "New"])
+    [0, 1]
+    """
+
+    def __init__(self, filename=None, totals=None):
+        self.filename = filename
+        self.totals = totals or {}
+        self.changed = False
+
+    @classmethod
+    def load(cls, filename):
+        """
+        The history in filename; empty if there is none or it can't be read.
+        """
+        totals = {}
+        try:
+            with open(filename) as stats_file:
+                totals = json.load(stats_file)
+            if not isinstance(totals, dict):
+                totals = {}
+        except (IOError, ValueError):
+            pass
+        return cls(filename, totals)
+
+    def record(self, name, seconds, size, failed):
+        """
+        Add one run of the hook called name, on size bytes of source.
+        """
+        totals = self.totals.setdefault(name, dict(runs=0, failures=0, seconds=0.0, kb=0.0))
+        totals["runs"] += 1
+        totals["failures"] += int(failed)
+        totals["seconds"] += seconds
+        totals["kb"] += size / 1024.0
+        if totals["runs"] >= MAX_RUNS:
+            for key in totals:
+                totals[key] /= 2.0
+        self.changed = True
+
+    def expected_cost(self, name):
+        """
+        Seconds per KB the hook spends for each failure it finds, or None without any history.
+
+        Running hooks in increasing order of this finds a failing file's first problem soonest.
+        """
+        totals = self.totals.get(name)
+        if not totals or not totals["runs"]:
+            return None
+        seconds_per_kb = totals["seconds"] / max(totals["kb"], 1e-3)
+        # smoothed, so a hook that hasn't failed yet still counts as able to
+        failure_rate = (totals["failures"] + 1.0) / (totals["runs"] + 2.0)
+        return seconds_per_kb / failure_rate
+
+    def ranked(self, names):
+        """
+        The indexes of names, in the order to run them: by expected cost, or as given if some
+        have no history yet.
+        """
+        costs = [self.expected_cost(name) for name in names]
+        if None in costs:
+            return range(len(names))
+        return sorted(range(len(names)), key=lambda index: (costs[index], index))
+
+    def save(self):
+        if self.filename is not None and self.changed:
+            write_file_atomically(self.filename, json.dumps(self.totals))
+            self.changed = False
+
+
+def stats_name(hook):
+    """
+    The name a hook's history is kept under: its stats_name if it has one, else its class name.
+    """
+    return getattr(hook, "stats_name", None) or hook.__class__.__name__
+
+
+def hook_order(hooks, stats, autofix=False):
+    """
+    The indexes of hooks in the order to run them. Hooks with run_first set stay at the front, in
+    their configured order; the others are ranked by stats.
+
+    With autofix, hooks that can fix what they find also stay in front, so a file isn't stopped
+    by a problem no hook fixes before its fixable ones are fixed.
+    """
+    first = [index for index, hook in enumerate(hooks)
+             if getattr(hook, "run_first", False) or (autofix and hasattr(hook, "fix"))]
+    rest = [index for index in range(len(hooks)) if index not in first]
+    ranks = stats.ranked([stats_name(hooks[index]) for index in rest])
+    return first + [rest[rank] for rank in ranks]
+
+
+def open_hook_stats():
+    """
+    The recorded history for this repository, or None if it can't be kept (no git dir, or no json).
+    """
+    git_dir = get_git_dir()
+    if git_dir is None or json is None:
+        return None
+    return HookStats.load(os.path.join(git_dir, "pygithooks", "hook-stats.json"))
@@ -5,154 +5,598 @@ precommit.py
 Runner of python-based precommit hooks.
 """
 
-import atexit
-import copy
+from __future__ import with_statement   # Python 2.5 compatibility.
+import optparse
 import os
-import shutil
 import sys
-import tempfile
+import time
 
+from autofix import FileFix, apply_fixes
+from blobs import BlobReader, BlobSizeReader
+from changed_lines import LineRanges, start_staged_changed_lines
+from check_external import batch_checks, configured_checkers
 from check_pep8 import CheckPep8
 from check_indentation import CheckIndentation
 from check_tabs import CheckTabs
-from util import get_config, run_command, run_piped_commands
+from engine import FileCheck, cpu_count, run_checks
+from hook_stats import hook_order, open_hook_stats
+from result_cache import DEFAULT_MAX_ENTRIES, open_result_cache
+from selection import FileSelector
+import tracing
+from util import BackgroundCommand, get_config, get_config_snapshot, get_git_dir, stream_records
 
 
-def is_python_file(filename):
+# Modes of index entries that aren't regular files: their contents are a link target or a commit id.
+SYMLINK_MODE = "120000"
+GITLINK_MODE = "160000"
+
+# With several jobs, how many listed files at a time are reordered to start the largest first.
+LARGEST_FIRST_WINDOW = 128
+
+
+def is_null_id(object_id):
+    return not object_id.strip("0")
+
+
+class StagedChange(object):
     """
-    Returns True iff the file contains python code.
+    One file changed between HEAD and the index, as `git diff-index --raw` reports it.
 
-    For now, just use the file extension. Could peek inside the file as well, but that's slower, and it's not
-    obvious what we should look for.
+    status: the change's one-letter status (A, M, T, ...)
+    old_mode, old_id: the file's mode and blob id in HEAD; zeros if it was added
+    new_mode, new_id: the same in the index
     """
-    return os.path.splitext(filename)[1] == ".py"
+
+    def __init__(self, status, path, old_mode, new_mode, old_id, new_id):
+        self.status = status
+        self.path = path
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+        self.old_id = old_id
+        self.new_id = new_id
+
+    def __repr__(self):
+        return "<StagedChange %s %s %s..%s>" % (self.status, self.path, self.old_id[:7], self.new_id[:7])
+
+    @property
+    def is_added(self):
+        return self.status == "A" or is_null_id(self.old_id)
+
+    @property
+    def mode_only(self):
+        """
+        True if only the file's mode changed, not its contents.
+        """
+        return not self.is_added and self.old_id == self.new_id
+
+    @property
+    def object_name(self):
+        """
+        What to ask git for the staged contents: the blob id, or the index path if there is none (unmerged).
+        """
+        if is_null_id(self.new_id):
+            return ":" + self.path
+        return self.new_id
+
+
+def parse_raw_diff(fields):
+    """
+    Generate a StagedChange for each entry of `git diff --raw -z` output, split on NULs.
+
+    Entries of a merge's combined diff (`-c`) have a mode, id and status for each parent; those
+    of the first parent are used.
+
+    >>> fields = [":100644 100755 %s %s M" % ("a" * 40, "a" * 40), "x.py",
+    ...           ":000000 100644 %s %s A" % ("0" * 40, "b" * 40), "new file.py",
+    ...           ":100644 100644 %s %s R090" % ("c" * 40, "d" * 40), "old.py", "new.py",
+    ...           "::100644 100644 100644 %s %s %s MM" % ("c" * 40, "d" * 40, "e" * 40), "merged.py", ""]
+    >>> [(change.status, change.path, change.is_added, change.mode_only) for change in parse_raw_diff(fields)]
+    [('M', 'x.py', False, True), ('A', 'new file.py', True, False), ('R', 'new.py', False, False), ('M', 'merged.py', False, False)]
+    >>> change = list(parse_raw_diff(fields))[-1]
+    >>> change.old_id == "c" * 40 and change.new_id == "e" * 40
+    True
+    """
+    fields = iter(fields)
+    for info in fields:
+        if not info:
+            continue
+        parents = len(info) - len(info.lstrip(":"))
+        info = info[parents:].split()
+        old_mode, new_mode = info[0], info[parents]
+        old_id, new_id = info[parents + 1], info[2 * parents + 1]
+        status = info[-1]
+        path = fields.next()
+        if status[0] in "CR":
+            # copies and renames list the source path, then the destination
+            path = fields.next()
+        yield StagedChange(status[0], path, old_mode, new_mode, old_id, new_id)
+
+
+def staged_changes():
+    """
+    Generate a StagedChange for each file changed in this commit, as git lists them. Excludes files that were just deleted.
+
+    Raises RuntimeError, after the last change, if git fails.
+    """
+    git_diff_command = ["git", "diff-index", "--cached", "--raw", "-z", "--diff-filter=ACMRTUXB", "HEAD"]
+    return parse_raw_diff(stream_records(git_diff_command))
 
 
-def changed_files(include_added_files=True):
+def merge_heads():
     """
-    Return a generator of filenames changed in this commit. Excludes files that were just deleted.
+    The other parents of the commit being made, from MERGE_HEAD, if it is a merge; else an empty list.
     """
-    diff_filter = "CMRTUXB"
-    if include_added_files:
-        diff_filter += "A"
+    git_dir = get_git_dir()
+    if git_dir is None:
+        return []
+    try:
+        with open(os.path.join(git_dir, "MERGE_HEAD")) as merge_head_file:
+            return [line.strip() for line in merge_head_file if line.strip()]
+    except IOError:
+        return []
 
-    git_diff_command = "git diff-index --cached --name-only --diff-filter=%s HEAD" % diff_filter
-    git_out, git_err, git_rc = run_command(git_diff_command)
 
-    if git_err or git_rc:
-        print "# Internal hook error:\n%s\n%s\n" % (git_out, git_err)
-        sys.exit(1)
+def start_merge_changes(parents):
+    """
+    Start listing, in the background, the staged files that differ from each of parents.
+
+    Returns a function that waits for the lists, and returns the set of files that differ from
+    every one of them. Raises RuntimeError if git fails.
+    """
+    commands = [BackgroundCommand(["git", "diff-index", "--cached", "--name-only", "-z", "--diff-filter=ACMRTUXB",
+                                   parent])
+                for parent in parents]
+
+    def changed_from_every_parent():
+        changed = None
+        for command in commands:
+            git_out, git_err, git_rc = command.wait()
+            if git_err or git_rc:
+                raise RuntimeError("git diff-index returned an error", command.argv, git_err)
+            changed_from_parent = set(path for path in git_out.split("\0") if path)
+            if changed is None:
+                changed = changed_from_parent
+            else:
+                changed &= changed_from_parent
+        return changed
+    return changed_from_every_parent
+
+
+def staged_candidates(selector, debug=False, get_merge_changes=None):
+    """
+    Generate (StagedChange, hook_indexes) for each changed file that some hook should check, as
+    chosen by selector, a selection.FileSelector.
 
-    cleaned_filenames = [filename.strip() for filename in git_out.splitlines()]
-    for filename in cleaned_filenames:
-        if len(filename) > 0:
-            yield filename
+    get_merge_changes: when committing a merge, a function returning the files that differ from
+        every merged branch (see start_merge_changes); the others are left out, since they come
+        unchanged from a branch. Called once git lists the first changed file.
+    """
+    return selector.with_python_shebangs(staged_selections(selector, debug, get_merge_changes),
+                                         lambda change: change.object_name)
 
 
-def make_temp_copy(temp_dir_with_slash, filename):
+def staged_selections(selector, debug=False, get_merge_changes=None):
     """
-    Create a temporary copy of a file from the index.
+    Generate (StagedChange, hook_indexes, needs_shebang) for staged_candidates.
     """
-    # TODO: Once all the hooks can take straight text rather than files, just return text.
+    merge_changes = None
+    for change in staged_changes():
+        filename = change.path
+        if debug:
+            print "Examining %s" % filename
 
-    temp_filename = os.path.join(temp_dir_with_slash, filename)
-    if os.path.isfile(temp_filename):
-        os.remove(temp_filename)
+        if get_merge_changes is not None:
+            if merge_changes is None:
+                merge_changes = get_merge_changes()
+            if filename not in merge_changes:
+                if debug:
+                    print "Skipping %s, unchanged from a merged branch" % filename
+                continue
 
-    git_cat_command = "git show :%(f)s" % dict(f=filename)
-    git_out, git_err, git_rc = run_command(git_cat_command)
+        hook_indexes, needs_shebang = selector.select(filename)
+        if hook_indexes is None:
+            if debug:
+                print "Skipping %s, not a python file" % filename
+            continue
 
-    if git_err or git_rc:
-        print("# Internal hook error:\n%(out)s\n%(err)s\n" % dict(out=git_out, err=git_err))
-        sys.exit(1)
+        if change.new_mode in (SYMLINK_MODE, GITLINK_MODE):
+            if debug:
+                print "Skipping %s, not a regular file" % filename
+            continue
 
-    try:
-        os.makedirs(os.path.dirname(temp_filename))
-    except OSError:
-        # dir already exists
-        pass
+        if change.mode_only:
+            if debug:
+                print "Skipping %s, only its mode changed" % filename
+            continue
 
-    with open(temp_filename, "wb") as temp_outfile:
-        temp_outfile.write(git_out)
+        if debug:
+            print "relevant hooks are: ", [selector.hooks[hook_index] for hook_index in hook_indexes]
+        if not hook_indexes:
+            if debug:
+                print "Skipping %s, no relevant hooks" % filename
+            continue
 
-    return temp_filename
+        yield change, hook_indexes, needs_shebang
 
 
-def main():
-    hooks = [CheckTabs(), CheckIndentation()]
+def sized_candidates(size_reader, candidates, max_file_size=0, oversized=None):
+    """
+    Generate (StagedChange, hook_indexes, size) for each (StagedChange, hook_indexes) candidate,
+    with the size of its staged contents from size_reader, a BlobSizeReader.
 
-    debug = get_config("debug", as_bool=True, default=False)
+    Candidates over max_file_size bytes (unless it is 0) are left out, and appended to oversized
+    as (filename, size), without their contents ever being read.
+    """
+    sizes = size_reader.read_blobs(candidates, object_name=lambda candidate: candidate[0].object_name)
+    for (change, hook_indexes), unused_object_id, size in sizes:
+        # a missing blob is reported when make_file_checks can't read it
+        size = size or 0
+        if max_file_size and size > max_file_size:
+            oversized.append((change.path, size))
+            continue
+        yield change, hook_indexes, size
+
+
+def largest_first(candidates, positions, window=LARGEST_FIRST_WINDOW):
+    """
+    Generate (StagedChange, hook_indexes, size) candidates, window of them at a time, largest
+    first within each window. positions[path] gets each candidate's place in the original order,
+    before it comes out (see in_order).
+
+    Only a window is held back, so checking starts, and continues, while git is still listing.
+
+    >>> candidates = [(StagedChange("M", path, "", "", "", ""), [], size)
+    ...               for path, size in [("a", 1), ("b", 3), ("c", 2), ("d", 1), ("e", 5)]]
+    >>> positions = {}
+    >>> [change.path for change, hook_indexes, size in largest_first(candidates, positions, window=3)]
+    ['b', 'c', 'a', 'e', 'd']
+    >>> sorted(positions.items())
+    [('a', 0), ('b', 1), ('c', 2), ('d', 3), ('e', 4)]
+    """
+    batch = []
+    for candidate in candidates:
+        positions[candidate[0].path] = len(positions)
+        batch.append(candidate)
+        if len(batch) >= window:
+            batch.sort(key=lambda candidate: candidate[2], reverse=True)
+            for candidate in batch:
+                yield candidate
+            batch = []
+    batch.sort(key=lambda candidate: candidate[2], reverse=True)
+    for candidate in batch:
+        yield candidate
+
+
+def in_order(results, positions):
+    """
+    Generate results, which may come in any order, in the order of positions[result.check.filename].
+
+    A result is held back until every earlier one has come. Results for files without a position
+    (or whose position has passed, like internal errors) come straight through.
+
+    >>> from engine import FileResult
+    >>> results = [FileResult(FileCheck(filename, None, [])) for filename in "cab"]
+    >>> [result.check.filename for result in in_order(results, dict(a=0, b=1, c=2))]
+    ['a', 'b', 'c']
+    """
+    pending = {}
+    next_position = 0
+    for result in results:
+        position = positions.get(result.check.filename)
+        if position is None or position < next_position:
+            yield result
+            continue
+        pending[position] = result
+        while next_position in pending:
+            yield pending.pop(next_position)
+            next_position += 1
+    for position in sorted(pending):
+        yield pending[position]
+
+
+def make_file_checks(blob_reader, candidates, with_previous=False, get_changed_lines=None):
+    """
+    Generate a FileCheck for each (StagedChange, hook_indexes) candidate, streaming its contents from git.
 
-    should_check_pep8 = get_config("check-pep8", as_bool=True, default=True)
-    if should_check_pep8:
+    candidates may be lazy; files are read, and can be checked, while git is still listing later ones.
+
+    with_previous: for incremental mode, also read each modified file's contents in HEAD
+    get_changed_lines: for line-range incremental mode, a function returning a dict of filename -> LineRanges
+        to report problems on; called once the first file has been read
+
+    Files with the same contents, hooks and settings (copies, renames, vendored duplicates) get
+    the same duplicate_key, so only the first is checked (see engine.run_checks).
+
+    Runs on a helper thread when checking in parallel, so errors are reported through the
+    FileCheck rather than raised.
+    """
+    def requests():
+        for change, hook_indexes in candidates:
+            yield change, hook_indexes, change.object_name
+            if with_previous and not change.is_added:
+                yield change, hook_indexes, change.old_id
+
+    responses = tracing.traced(blob_reader.read_blobs(requests(), object_name=lambda request: request[2]),
+                               "read blob", "blob", lambda response: dict(object=response[1], bytes=len(response[2] or "")))
+    filename, hook_indexes = None, []
+    changed_lines = None
+    try:
+        for (change, hook_indexes, object_name), object_id, code in responses:
+            if get_changed_lines is not None and changed_lines is None:
+                with tracing.span("changed_lines"):
+                    changed_lines = get_changed_lines()
+            filename = change.path
+            previous_code = previous_object_id = None
+            if with_previous and not change.is_added:
+                unused_request, previous_object_id, previous_code = responses.next()
+                if previous_code is None:
+                    yield FileCheck(filename, None, hook_indexes,
+                                    error="could not read %s (%s) from HEAD" % (filename, change.old_id))
+                    return
+            if code is None:
+                yield FileCheck(filename, None, hook_indexes, error="could not read %s from the index" % object_name)
+                return
+
+            file_changed_lines = None
+            if changed_lines is not None:
+                file_changed_lines = changed_lines.get(filename, LineRanges())
+            duplicate_key = (object_id, previous_object_id, tuple(hook_indexes), repr(file_changed_lines))
+            yield FileCheck(filename, code, hook_indexes, previous_code,
+                            object_id=object_id, previous_object_id=previous_object_id,
+                            changed_lines=file_changed_lines, duplicate_key=duplicate_key)
+    except (RuntimeError, EnvironmentError), e:
+        yield FileCheck(filename, None, hook_indexes, error="\n".join(map(str, e.args)))
+
+
+def main(argv=None):
+    """
+    Run the hooks, with profiling if `pygithooks.profile` names a trace file to write.
+    """
+    start, cpu_start = time.time(), tracing.cpu_time()
+    # the first config lookup loads the whole configuration
+    profile = get_config("profile", default="")
+    if not profile:
+        return run(argv)
+
+    tracing.start_recording()
+    tracing.record("config", "phase", start, time.time(), cpu_start, tracing.cpu_time())
+    try:
+        with tracing.span("run", "run"):
+            return run(argv)
+    finally:
+        try:
+            summary = tracing.write_trace(profile)
+        except EnvironmentError, e:
+            print "# Could not write profile to %s: %s" % (profile, e)
+        else:
+            print "# Profile written to %s" % profile
+            for line in summary:
+                print "#   " + line
+
+
+def make_hooks():
+    """
+    The configured hooks, in their default order: the built-in ones, then external checkers.
+    """
+    hooks = [CheckTabs(), CheckIndentation()]
+    if get_config("check-pep8", as_bool=True, default=True):
         hooks += [CheckPep8()]
+    hooks += configured_checkers()
+    return hooks
 
-    incremental = get_config("incremental", as_bool=True, default=False)
-    incremental_verbose = get_config("incremental.verbose", as_bool=True,
-                                     default=False)
 
-    if debug:
-        print "Starting hooks, with pep8 %s, incremental %s, hooks [%s]" % (should_check_pep8, incremental, ", ".join(map(str, hooks)))
+def make_selector(hooks):
+    """
+    The FileSelector choosing which of hooks check which files, as configured.
+    """
+    return FileSelector(hooks, detect_shebangs=get_config("python-shebang", as_bool=True, default=False))
 
-    # create temp directory for getting copies of files from staging.
-    # TODO: Make all the hooks operate on strings instead of files, and get rid of this.
-    temp_dir = tempfile.mkdtemp()
-    temp_dir_with_slash = temp_dir + os.sep
 
-    atexit.register(shutil.rmtree, temp_dir, True)  # clean up after ourselves
+# In a warm server (see keep_warm), (what they were made from, hooks, selector, result cache)
+# from the last run.
+_warm_state = None
+_keep_warm = False
 
-    failure_encountered = False
 
-    if incremental:
-        # Incremental checking requires checking the previous version of a
-        # file for errors, but if the file was added, we can't do that.
-        # Get a list of non-added changed files here to check against.
-        modified_files = frozenset(changed_files(include_added_files=False))
+def keep_warm():
+    """
+    Keep the hooks, their selector and the result cache from one run to the next, for as long
+    as the configuration is unchanged. For the warm server, which runs one commit at a time.
+    """
+    global _keep_warm
+    _keep_warm = True
 
-    for filename in changed_files():
-        if debug:
-            print "Examining %s" % filename
 
-        if not is_python_file(filename):
-            if debug:
-                print "Skipping %s, not a python file" % filename
-            continue
+def configured_state():
+    """
+    (hooks, selector, result cache or None), as configured.
+    """
+    global _warm_state
+    # the hooks work from the current directory, and the cache lives in the git dir
+    made_from = (get_config_snapshot().values, os.getcwd(), get_git_dir())
+    if _keep_warm and _warm_state is not None and _warm_state[0] == made_from:
+        unused_made_from, hooks, selector, cache = _warm_state
+        # in case the last run stopped without closing it
+        selector.abort()
+        if cache is not None:
+            # the counts are per run
+            cache.hits = cache.misses = 0
+        return hooks, selector, cache
+
+    hooks = make_hooks()
+    selector = make_selector(hooks)
+    cache = open_result_cache(enabled=get_config("cache", as_bool=True, default=True),
+                              max_entries=get_config("cache-size", as_int=True, default=DEFAULT_MAX_ENTRIES))
+    if _keep_warm:
+        if _warm_state is not None and _warm_state[3] is not None:
+            _warm_state[3].close()
+        _warm_state = (made_from, hooks, selector, cache)
+    return hooks, selector, cache
+
+
+def run(argv=None):
+    parser = optparse.OptionParser(usage="%prog [--all | --rev TREE-ISH]",
+                                   description="Check the files staged for commit, or with --all or --rev, "
+                                               "every Python file in a commit or tree.")
+    parser.add_option("--all", action="store_true", default=False,
+                      help="check every Python file in HEAD")
+    parser.add_option("--rev", metavar="TREE-ISH",
+                      help="check every Python file in TREE-ISH")
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error("unexpected arguments: %s" % " ".join(args))
+
+    hooks, selector, cache = configured_state()
+    should_check_pep8 = any(isinstance(hook, CheckPep8) for hook in hooks)
 
-        relevant_hooks = [hook for hook in hooks if hook.should_process_file(filename)]
-	if debug:
-            print "relevant hooks are: ", relevant_hooks
-        if not relevant_hooks:
-            if debug:
-                print "Skipping %s, no relevant hooks" % filename
-            continue
+    debug = get_config("debug", as_bool=True, default=False)
 
-        if incremental and filename in modified_files:
-            head_temp_filename = make_temp_copy(temp_dir_with_slash, filename)
-            incremental_hooks = copy.copy(relevant_hooks)
-            if os.path.isfile(head_temp_filename):
-                # This is not a newly added file, so check whether it used to fail the hooks.
-                for relevant_hook in relevant_hooks:
-                    head_passes, unused_error_message = relevant_hook.file_passes(head_temp_filename, original_filename=filename)
-                    if not head_passes:
-                        # Incremental checking was requested, and current HEAD doesn't pass,
-                        # so don't bother checking this file with this hook.
-                        incremental_hooks.remove(relevant_hook)
-                        if incremental_verbose:
-                            print "Hook %s failed on current HEAD for file %s" % (relevant_hook, filename)
-            relevant_hooks = incremental_hooks
-
-        if not relevant_hooks:
-            if debug:
-                print "Skipping %s, no relevant hooks (after incremental check)" % filename
-            continue
+    # incremental is a bool, or "lines" to only report problems on added and modified lines
+    line_incremental = get_config("incremental", default="").strip().lower() == "lines"
+    incremental = not line_incremental and get_config("incremental", as_bool=True, default=False)
+    incremental_verbose = get_config("incremental.verbose", as_bool=True,
+                                     default=False)
+
+    autofix = get_config("autofix", as_bool=True, default=False)
+    autofix_work_tree = autofix and get_config("autofix.worktree", as_bool=True, default=False)
+
+    fail_fast = get_config("fail-fast", as_bool=True, default=False)
 
-        temp_filename = make_temp_copy(temp_dir_with_slash, filename)
-        for relevant_hook in relevant_hooks:
-            passes, error_message = relevant_hook.file_passes(temp_filename, original_filename=filename)
-            if not passes:
+    max_file_size = get_config("max-file-size", as_int=True, default=0)
+    max_file_size_action = get_config("max-file-size.action", default="warn").strip().lower()
+
+    jobs = get_config("jobs", as_int=True, default=0)
+    if jobs <= 0:
+        jobs = cpu_count()
+
+    if debug:
+        print "Starting hooks, with pep8 %s, incremental %s, autofix %s, jobs %s, hooks [%s]" % (should_check_pep8, "lines" if line_incremental else incremental, "worktree" if autofix_work_tree else autofix, jobs, ", ".join(map(str, hooks)))
+
+    if options.all or options.rev:
+        # imported here; audit uses this module's helpers
+        from audit import audit_tree
+        return audit_tree(options.rev or "HEAD", hooks, jobs=jobs, cache=cache, debug=debug,
+                          max_file_size=max_file_size, max_file_size_action=max_file_size_action,
+                          selector=selector)
+
+    failure_encountered = False
+
+    get_changed_lines = None
+    if line_incremental:
+        # One diff for the whole commit says which lines each file's problems are reported on;
+        # git computes it while it lists the changed files.
+        get_changed_lines = start_staged_changed_lines()
+
+    get_merge_changes = None
+    parents = merge_heads()
+    if parents and not get_config("merge.all-files", as_bool=True, default=False):
+        # A merge only needs the files it changed from every parent: conflict resolutions and
+        # other edits. Files taken as they are from a merged branch were checked there.
+        if debug:
+            print "Committing a merge with %s; only checking files that differ from every parent" % ", ".join(parents)
+        get_merge_changes = start_merge_changes(parents)
+
+    # Size every changed file with one `cat-file --batch-check` as git lists them, before reading any.
+    size_reader = BlobSizeReader()
+    oversized = []
+    candidates = sized_candidates(size_reader, staged_candidates(selector, debug, get_merge_changes),
+                                  max_file_size, oversized)
+    positions = None
+    if jobs > 1 and not fail_fast:
+        # Check the largest of each window of listed files first, so the small ones fill in around
+        # them instead of one big file starting last and running alone. Output is put back in the
+        # order git listed the files.
+        positions = {}
+        candidates = largest_first(candidates, positions)
+    candidates = ((change, hook_indexes) for change, hook_indexes, size in candidates)
+
+    # Fetch every staged blob through one cat-file process; git lists the changed files, and the
+    # contents stream in, while we check (a window behind with several jobs).
+    blob_reader = BlobReader()
+    checks = make_file_checks(blob_reader, candidates, incremental, get_changed_lines)
+    # External checkers get many files per run, instead of being started for each one.
+    checks = batch_checks(checks, hooks, jobs, cache)
+
+    # With fail-fast, every hook run is timed, and the hooks likeliest to find a problem soonest run
+    # first. Otherwise they keep their configured order: a file stops at its first failing hook,
+    # so a given problem always gets the same message. No history is read or written then.
+    hook_stats = None
+    if fail_fast:
+        hook_stats = open_hook_stats()
+    order = None
+    if hook_stats is not None:
+        order = hook_order(hooks, hook_stats, autofix)
+        if debug:
+            print "Hook order: %s" % ", ".join(str(hooks[hook_index]) for hook_index in order)
+
+    fast_path_counts = {}
+    fixes = []
+    files_checked = 0
+    with tracing.span("check files") as span:
+        # with fail-fast, whichever failure the workers find first stops the run
+        results = run_checks(hooks, checks, jobs=jobs, cache=cache, fast_path_counts=fast_path_counts,
+                             hook_stats=hook_stats, ordered=not fail_fast, debug=debug,
+                             incremental_verbose=incremental_verbose, autofix=autofix, hook_order=order,
+                             profile=tracing.is_recording())
+        if positions is not None:
+            results = in_order(results, positions)
+        for result in results:
+            files_checked += 1
+            if result.fixed_code is not None:
+                fixes.append(FileFix(result.check.filename, result.check.object_id, result.fixed_code))
+            if result.output:
+                with tracing.span("output", "output", file=result.check.filename):
+                    for line in result.output:
+                        print(line)
+            if result.failed:
                 failure_encountered = True
-                print(error_message)
+            if result.internal_error:
+                sys.exit(1)
+            if failure_encountered and fail_fast:
+                # the commit fails whatever the other files hold; stop the workers and git
+                results.close()
+                selector.abort()
+                size_reader.abort()
+                blob_reader.abort()
+                print "# Stopped at the first failure (pygithooks.fail-fast); other files were not checked"
                 break
+        span.args["files"] = files_checked
+
+    if oversized and max_file_size_action != "skip":
+        for filename, size in oversized:
+            print "# Not checking %s: it is %d bytes, over pygithooks.max-file-size (%d)" % (filename, size,
+                                                                                             max_file_size)
+
+    if fixes:
+        # Every fixed file goes into the index at once, so the commit can go ahead without another run.
+        try:
+            with tracing.span("autofix", files=len(fixes)):
+                fix_output, all_fixed = apply_fixes(fixes, write_work_tree=autofix_work_tree)
+        except RuntimeError, e:
+            print "# Internal hook error:\n%s\n" % "\n".join(map(str, e.args[1:]))
+            sys.exit(1)
+        for line in fix_output:
+            print(line)
+        if not all_fixed:
+            failure_encountered = True
+
+    if hook_stats is not None:
+        hook_stats.save()
+
+    if cache is not None:
+        with tracing.span("cache flush"):
+            cache.flush()
+        if debug:
+            print "Result cache: %d hits, %d misses" % (cache.hits, cache.misses)
+
+    selector.close()
+    size_reader.close()
+    blob_reader.close()
+    if debug:
+        for hook_index, (decided, tried) in sorted(fast_path_counts.items()):
+            print "Fast path for %s decided %d of %d files" % (hooks[hook_index], decided, tried)
+        print "Read %d blobs (%d bytes) through one git cat-file process, %d processes saved" % (
+            blob_reader.blobs_read, blob_reader.bytes_read, blob_reader.processes_saved)
 
     return int(failure_encountered)
 
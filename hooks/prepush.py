@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+prepush.py
+
+Pre-push hook: checks every Python file added or modified by the commits being pushed, so
+formatting is enforced even for commits made without the pre-commit hook.
+
+git runs it with the remote's name and URL as arguments, and a line per ref being pushed on stdin:
+
+    <local ref> <local object id> <remote ref> <remote object id>
+
+The pushed commits' changes are listed with one `git rev-list | git diff-tree --stdin` pipeline;
+a merge's are the files it changed from every parent.
+Each distinct blob is checked once, however many commits it appears in, under the path it had
+in the newest of them.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+import sys
+import time
+
+from blobs import BlobReader, BlobSizeReader
+from check_external import batch_checks
+from engine import cpu_count, run_checks
+from precommit import (GITLINK_MODE, SYMLINK_MODE, is_null_id, make_file_checks, make_hooks, make_selector,
+                       parse_raw_diff, sized_candidates)
+from result_cache import DEFAULT_MAX_ENTRIES, open_result_cache
+import tracing
+from util import get_config, run_piped_commands
+
+
+def pushed_revisions(ref_lines, remote=None):
+    """
+    rev-list arguments selecting the commits being pushed, from the lines git gives the pre-push hook.
+
+    Commits already on the remote's tracking branches are left out, so a new branch only brings
+    its own commits. Returns None if nothing is being pushed (only deletions).
+
+    >>> pushed_revisions(["refs/heads/a %s refs/heads/a %s\\n" % ("1" * 40, "2" * 40),
+    ...                   "(delete) %s refs/heads/b %s\\n" % ("0" * 40, "3" * 40)], "origin")
+    ['1111111111111111111111111111111111111111', '--not', '2222222222222222222222222222222222222222', '--remotes=origin']
+    >>> pushed_revisions(["(delete) %s refs/heads/b %s\\n" % ("0" * 40, "3" * 40)], "origin") is None
+    True
+    """
+    pushed, already_there = [], []
+    for line in ref_lines:
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        unused_local_ref, local_id, unused_remote_ref, remote_id = fields
+        if is_null_id(local_id):
+            continue
+        pushed.append(local_id)
+        if not is_null_id(remote_id):
+            already_there.append(remote_id)
+    if not pushed:
+        return None
+    revisions = pushed + ["--not"] + already_there
+    if remote:
+        revisions.append("--remotes=%s" % remote)
+    return revisions
+
+
+def pushed_changes(revisions):
+    """
+    The changes made by each commit in revisions, newest first, as precommit.StagedChanges.
+
+    A merge's changes are the files that differ from every parent: conflict resolutions and other
+    edits made in the merge, as when committing one (see precommit.start_merge_changes). Files
+    taken unchanged from a merged branch come with that branch's own commits.
+    Raises RuntimeError if git fails.
+    """
+    # --ignore-missing: a remote tip we never fetched, e.g. when force-pushing over it
+    rev_list_command = ["git", "rev-list", "--ignore-missing"] + revisions
+    # -c: a merge's combined diff, listing only files that differ from every parent
+    diff_tree_command = ["git", "diff-tree", "--stdin", "--root", "-r", "-c", "--raw", "-z", "--no-commit-id",
+                         "--diff-filter=ACMRTB"]
+    git_out, git_err, git_rc = run_piped_commands([rev_list_command, diff_tree_command])
+    if git_err or git_rc:
+        raise RuntimeError("git rev-list | git diff-tree returned an error", git_err)
+    return parse_raw_diff(git_out.split("\0"))
+
+
+def pushed_candidates(changes, selector, incremental=False, debug=False):
+    """
+    Generate (change, hook_indexes) for each distinct blob some hook should check, as chosen by
+    selector, a selection.FileSelector.
+
+    A blob is checked once for each set of hooks that applies to it (and, in incremental mode, for
+    each earlier version it replaced), under the first path it is seen at.
+    """
+    def selections():
+        for change in changes:
+            if change.new_mode in (SYMLINK_MODE, GITLINK_MODE) or change.mode_only:
+                continue
+            hook_indexes, needs_shebang = selector.select(change.path)
+            if hook_indexes:
+                yield change, hook_indexes, needs_shebang
+
+    seen = set()
+    for change, hook_indexes in selector.with_python_shebangs(selections(), lambda change: change.new_id):
+        key = (change.new_id, change.old_id if incremental else None, tuple(hook_indexes))
+        if key in seen:
+            if debug:
+                print "Skipping %s (%s), already checked" % (change.path, change.new_id)
+            continue
+        seen.add(key)
+        yield change, hook_indexes
+
+
+def main(argv=None, ref_lines=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if ref_lines is None:
+        ref_lines = sys.stdin.readlines()
+    remote = argv[0] if argv else None
+
+    if not get_config("pre-push", as_bool=True, default=True):
+        return 0
+
+    start_time = time.time()
+    hooks = make_hooks()
+    selector = make_selector(hooks)
+    debug = get_config("debug", as_bool=True, default=False)
+    # "lines" can't be told apart per commit here, so it checks like plain incremental mode
+    incremental = get_config("incremental", default="").strip().lower() == "lines" or \
+        get_config("incremental", as_bool=True, default=False)
+    incremental_verbose = get_config("incremental.verbose", as_bool=True, default=False)
+    max_file_size = get_config("max-file-size", as_int=True, default=0)
+    jobs = get_config("jobs", as_int=True, default=0)
+    if jobs <= 0:
+        jobs = cpu_count()
+    cache = open_result_cache(enabled=get_config("cache", as_bool=True, default=True),
+                              max_entries=get_config("cache-size", as_int=True, default=DEFAULT_MAX_ENTRIES))
+
+    revisions = pushed_revisions(ref_lines, remote)
+    if revisions is None:
+        return 0
+
+    try:
+        with tracing.span("changed_files"):
+            changes = list(pushed_changes(revisions))
+    except RuntimeError, e:
+        print "# Internal hook error:\n%s\n" % "\n".join(map(str, e.args))
+        return 1
+
+    size_reader = BlobSizeReader()
+    blob_reader = BlobReader()
+    oversized = []
+    candidates = sized_candidates(size_reader, pushed_candidates(changes, selector, incremental, debug),
+                                  max_file_size, oversized)
+    candidates = ((change, hook_indexes) for change, hook_indexes, size in candidates)
+    checks = batch_checks(make_file_checks(blob_reader, candidates, incremental), hooks, jobs, cache)
+
+    files_checked = files_failed = 0
+    internal_error = False
+    with tracing.span("check files"):
+        for result in run_checks(hooks, checks, jobs=jobs, cache=cache, debug=debug,
+                                 incremental_verbose=incremental_verbose, profile=tracing.is_recording()):
+            if result.output:
+                for line in result.output:
+                    print(line)
+            if result.internal_error:
+                internal_error = True
+                break
+            files_checked += 1
+            files_failed += result.failed
+    if internal_error:
+        selector.abort()
+        size_reader.abort()
+        blob_reader.abort()
+    else:
+        selector.close()
+        size_reader.close()
+        blob_reader.close()
+
+    if cache is not None:
+        cache.flush()
+
+    if oversized and get_config("max-file-size.action", default="warn").strip().lower() != "skip":
+        for filename, size in oversized:
+            print "# Not checking %s: it is %d bytes, over pygithooks.max-file-size (%d)" % (filename, size,
+                                                                                             max_file_size)
+    if files_failed:
+        print "# Push rejected: %d of the %d distinct files pushed failed the hooks (checked in %.1fs)" % (
+            files_failed, files_checked, time.time() - start_time)
+    return int(bool(files_failed or internal_error))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -41,6 +41,7 @@ you'd prefer. You can always use the --nobackup option to prevent this.
 
 __version__ = "1"
 
+import array
 import tokenize
 import os
 import shutil
@@ -151,10 +152,7 @@ def _rstrip(line, JUNK='\n \t'):
     mentioning Barry by name or anything <wink>.
     """
 
-    i = len(line)
-    while i > 0 and line[i - 1] in JUNK:
-        i -= 1
-    return line[:i]
+    return line.rstrip(JUNK)
 
 
 class Reindenter:
@@ -163,43 +161,70 @@ class Reindenter:
         self.find_stmt = 1  # next token begins a fresh stmt?
         self.level = 0      # current indent level
 
-        # Raw file lines.
-        self.raw = f.readlines()
-
         # File lines, rstripped & tab-expanded.  Dummy at start is so
         # that we can use tokenize's 1-based line numbering easily.
         # Note that a line is all-blank iff it's "\n".
-        self.lines = [_rstrip(line).expandtabs() + "\n"
-                      for line in self.raw]
-        self.lines.insert(0, None)
+        # The raw lines aren't kept, just the numbers of the lines that
+        # differ from them.
+        self.lines = [None]
+        self.dirty_lines = array.array("l")
+        for raw_line in f.readlines():
+            line = _rstrip(raw_line).expandtabs() + "\n"
+            if line != raw_line:
+                self.dirty_lines.append(len(self.lines))
+            self.lines.append(line)
+        self.raw_count = len(self.lines) - 1
+        self.raw_is_clean = not self.dirty_lines
         self.index = 1  # index into self.lines of next line
 
-        # List of (lineno, indentlevel) pairs, one for each stmt and
-        # comment line.  indentlevel is -1 for comment lines, as a
+        # One entry for each stmt and comment line: its line number and
+        # its indent level.  The level is -1 for comment lines, as a
         # signal that tokenize doesn't know what to do about them;
         # indeed, they're our headache!
-        self.stats = []
-
-    def run(self):
-        tokenize.tokenize(self.getline, self.tokeneater)
+        self.stat_lines = array.array("l")
+        self.stat_levels = array.array("l")
+
+        # (first line, end line, diff) for each run of lines the
+        # transformation shifts right (diff > 0) or left by diff columns;
+        # every other line is just copied.  Filled in by run().
+        self.shifts = []
+
+    def run(self, tokens=None):
+        # tokens: optionally, the already-tokenized lines (see can_reuse_tokens)
+        if tokens is None:
+            tokenize.tokenize(self.getline, self.tokeneater)
+        else:
+            for token_info in tokens:
+                self.tokeneater(*token_info)
         # Remove trailing empty lines.
         lines = self.lines
-        while lines and lines[-1] == "\n":
+        changed = not self.raw_is_clean
+        while lines[-1] == "\n":
             lines.pop()
+            changed = True
         # Sentinel.
-        stats = self.stats
-        stats.append((len(lines), 0))
+        stat_lines, stat_levels = self.stat_lines, self.stat_levels
+        stat_lines.append(len(lines))
+        stat_levels.append(0)
+        stat_count = len(stat_lines) - 1
+        # Index of the first real stmt after each entry, or -1: an indented
+        # comment looks ahead to it, and looking it up instead of scanning
+        # keeps long runs of comments linear.
+        next_real = array.array("l", [-1]) * stat_count
+        following = -1
+        for i in xrange(stat_count - 1, -1, -1):
+            next_real[i] = following
+            if stat_levels[i] >= 0:
+                following = i
+        # How far the most recent real stmt got shifted; a hanging comment
+        # after it is shifted the same.
+        last_real_diff = None
         # Map count of leading spaces to # we want.
         have2want = {}
-        # Program after transformation.
-        after = self.after = []
-        # Copy over initial empty lines -- there's nothing to do until
-        # we see a line with *something* on it.
-        i = stats[0][0]
-        after.extend(lines[1:i])
-        for i in range(len(stats) - 1):
-            thisstmt, thislevel = stats[i]
-            nextstmt = stats[i + 1][0]
+        shifts = self.shifts = []
+        for i in xrange(stat_count):
+            thisstmt = stat_lines[i]
+            thislevel = stat_levels[i]
             have = getlspace(lines[thisstmt])
             want = thislevel * 4
             if want < 0:
@@ -211,22 +236,14 @@ class Reindenter:
                     want = have2want.get(have, -1)
                     if want < 0:
                         # Then it probably belongs to the next real stmt.
-                        for j in xrange(i + 1, len(stats) - 1):
-                            jline, jlevel = stats[j]
-                            if jlevel >= 0:
-                                if have == getlspace(lines[jline]):
-                                    want = jlevel * 4
-                                break
-                    if want < 0:           # Maybe it's a hanging
-                                           # comment like this one,
+                        j = next_real[i]
+                        if j >= 0 and have == getlspace(lines[stat_lines[j]]):
+                            want = stat_levels[j] * 4
+                    if want < 0 and last_real_diff is not None:
+                        # Maybe it's a hanging comment like this one,
                         # in which case we should shift it like its base
                         # line got shifted.
-                        for j in xrange(i - 1, -1, -1):
-                            jline, jlevel = stats[j]
-                            if jlevel >= 0:
-                                want = have + getlspace(after[jline - 1]) - \
-                                       getlspace(lines[jline])
-                                break
+                        want = have + last_real_diff
                     if want < 0:
                         # Still no luck -- leave it alone.
                         want = have
@@ -236,21 +253,69 @@ class Reindenter:
             have2want[have] = want
             diff = want - have
             if diff == 0 or have == 0:
-                after.extend(lines[thisstmt:nextstmt])
+                diff = 0
             else:
-                for line in lines[thisstmt:nextstmt]:
-                    if diff > 0:
-                        if line == "\n":
-                            after.append(line)
-                        else:
-                            after.append(" " * diff + line)
-                    else:
-                        remove = min(getlspace(line), -diff)
-                        after.append(line[remove:])
-        return self.raw != self.after
+                # The first line of the run is a stmt or comment, so it
+                # really changes.
+                shifts.append((thisstmt, stat_lines[i + 1], diff))
+                changed = True
+            if thislevel >= 0:
+                last_real_diff = diff
+        return changed
+
+    def iter_after(self):
+        """Generate the lines of the program after transformation."""
+        lines = self.lines
+        copied = 1
+        for first, end, diff in self.shifts:
+            for index in xrange(copied, first):
+                yield lines[index]
+            for index in xrange(first, end):
+                yield shift_line(lines[index], diff)
+            copied = end
+        for index in xrange(copied, len(lines)):
+            yield lines[index]
+
+    def changes(self):
+        """Generate (lineno, new line) for each line the transformation
+        changes, in order; new line is None for trailing blank lines it
+        removes.
+
+        Line n of the output is line n of the input, transformed, so this
+        is everything a diff needs, without comparing whole files.
+        """
+        lines = self.lines
+        last = len(lines) - 1
+        dirty = self.dirty_lines
+        next_dirty = 0
+        for first, end, diff in self.shifts + [(last + 1, last + 1, 0)]:
+            # Lines cleaned up but not shifted.
+            while next_dirty < len(dirty) and dirty[next_dirty] < first:
+                yield dirty[next_dirty], lines[dirty[next_dirty]]
+                next_dirty += 1
+            for index in xrange(first, end):
+                line = lines[index]
+                new_line = shift_line(line, diff)
+                is_dirty = next_dirty < len(dirty) and dirty[next_dirty] == index
+                if is_dirty:
+                    next_dirty += 1
+                if is_dirty or new_line != line:
+                    yield index, new_line
+        for index in xrange(last + 1, self.raw_count + 1):
+            yield index, None
+
+    @property
+    def after(self):
+        """Program after transformation, as a list of lines."""
+        return list(self.iter_after())
 
     def write(self, f):
-        f.writelines(self.after)
+        f.writelines(self.iter_after())
+
+    def can_reuse_tokens(self):
+        """Return True iff tokenizing the raw lines gives the same tokens as
+        tokenizing the rstripped, tab-expanded lines, i.e. they're equal."""
+        return self.raw_is_clean
 
     # Line-getter for tokenize.
     def getline(self):
@@ -285,7 +350,8 @@ class Reindenter:
 
         elif type == COMMENT:
             if self.find_stmt:
-                self.stats.append((sline, -1))
+                self.stat_lines.append(sline)
+                self.stat_levels.append(-1)
                 # but we're still looking for a new stmt, so leave
                 # find_stmt alone
 
@@ -298,15 +364,24 @@ class Reindenter:
             # ENDMARKER.
             self.find_stmt = 0
             if line:   # not endmarker
-                self.stats.append((sline, self.level))
+                self.stat_lines.append(sline)
+                self.stat_levels.append(self.level)
+
+
+def shift_line(line, diff):
+    """Shift line right (diff > 0) or left by diff columns, leaving blank
+    lines alone and removing no more than its leading blanks."""
+    if diff > 0:
+        if line == "\n":
+            return line
+        return " " * diff + line
+    remove = min(getlspace(line), -diff)
+    return line[remove:]
 
 
 # Count number of leading blanks.
 def getlspace(line):
-    i, n = 0, len(line)
-    while i < n and line[i] == " ":
-        i += 1
-    return i
+    return len(line) - len(line.lstrip(" "))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Persistent cache of hook results, keyed by blob contents.
+
+A hook's verdict on a blob only changes when the hook or its settings change, so results are
+stored under a key combining the blob's object id, the hook's identity and version, and a
+fingerprint of its settings. Amends, rebases and retried commits then skip the work entirely.
+
+The cache lives in an sqlite database under the git dir; sqlite's locking keeps it safe when
+several commits run at once. It holds at most a fixed number of entries, evicting the least
+recently used.
+"""
+
+try:
+    import hashlib
+    sha1 = hashlib.sha1
+except ImportError:
+    import sha
+    sha1 = sha.new
+import os
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None  # Python built without sqlite; nothing is cached.
+import sys
+import time
+
+from util import get_git_dir
+
+
+DEFAULT_MAX_ENTRIES = 20000
+
+
+class UncachedMessage(str):
+    """
+    An error message for a result that mustn't be cached, because it says nothing about the file:
+    e.g. a checker that couldn't be run. The file is checked again next time.
+    """
+
+
+def hook_identity(hook):
+    """
+    A string identifying a hook, its version and its settings, or None if the hook can't be cached.
+
+    Hooks opt in to caching by defining a `version` attribute; hooks with settings that affect
+    their results also define settings(), returning something with a stable repr.
+    """
+    version = getattr(hook, "version", None)
+    if version is None:
+        return None
+    settings = hook.settings() if hasattr(hook, "settings") else ()
+    return "%s.%s:%s:%r:%s" % (hook.__class__.__module__,
+                               hook.__class__.__name__,
+                               version,
+                               settings,
+                               ".".join(map(str, sys.version_info[:2])))
+
+
+def default_cache_filename():
+    git_dir = get_git_dir()
+    if git_dir is None:
+        return None
+    return os.path.join(git_dir, "pygithooks", "results.sqlite")
+
+
+class ResultCache(object):
+    """
+    Maps (object id, hook identity) to (passes, error_message).
+
+    Error messages mention the file's path, so a cached failure is only reused for the same path;
+    a cached pass is reused for any path.
+    """
+
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.connection = None
+        self.hits = 0
+        self.misses = 0
+        self.pending_results = []
+        self.pending_used_keys = []
+
+    def __getstate__(self):
+        # worker processes open their own connection
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
+
+    def __str__(self):
+        return "<ResultCache %s: %d hits, %d misses>" % (self.filename, self.hits, self.misses)
+
+    def _connect(self):
+        if self.connection is None:
+            try:
+                os.makedirs(os.path.dirname(self.filename))
+            except OSError:
+                # dir already exists
+                pass
+            # wait for other commits holding the lock rather than failing
+            self.connection = sqlite3.connect(self.filename, timeout=30)
+            self.connection.text_factory = str
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                    "key TEXT PRIMARY KEY, passes INTEGER, error_message TEXT, "
+                                    "path TEXT, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self.connection.commit()
+        return self.connection
+
+    @staticmethod
+    def key(object_id, identity):
+        return sha1("%s\0%s" % (object_id, identity)).hexdigest()
+
+    def get(self, key, path):
+        """
+        Return (passes, error_message) if there's a usable cached result, else None.
+        """
+        try:
+            row = self._connect().execute("SELECT passes, error_message, path FROM results WHERE key = ?",
+                                          (key,)).fetchone()
+        except (sqlite3.Error, EnvironmentError):
+            row = None
+        if row is None or (not row[0] and row[2] != path):
+            return None
+        return bool(row[0]), row[1]
+
+    def record(self, new_results, used_keys):
+        """
+        Note results computed on a miss, as (key, passes, error_message, path) tuples, and
+        the keys of results used on a hit. Nothing is written until flush().
+        """
+        self.misses += len(new_results)
+        self.hits += len(used_keys)
+        self.pending_results.extend(new_results)
+        self.pending_used_keys.extend(used_keys)
+
+    def flush(self):
+        """
+        Store recorded results, mark used entries as recently used, and evict the least
+        recently used entries beyond max_entries.
+
+        Everything happens in one transaction. Failures are ignored; it's only a cache.
+        """
+        new_results, self.pending_results = self.pending_results, []
+        used_keys, self.pending_used_keys = self.pending_used_keys, []
+        if not new_results and not used_keys:
+            return
+        now = time.time()
+        try:
+            connection = self._connect()
+            connection.executemany("INSERT OR REPLACE INTO results (key, passes, error_message, path, last_used) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   [(key, int(passes), error_message, path, now)
+                                    for key, passes, error_message, path in new_results])
+            connection.executemany("UPDATE results SET last_used = ? WHERE key = ?",
+                                   [(now, key) for key in used_keys])
+            if new_results:
+                connection.execute("DELETE FROM results WHERE key IN "
+                                   "(SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                                   (self.max_entries,))
+            connection.commit()
+        except (sqlite3.Error, EnvironmentError):
+            if self.connection is not None:
+                try:
+                    self.connection.rollback()
+                except sqlite3.Error:
+                    pass
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def open_result_cache(enabled=True, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Returns a ResultCache for the current repository, or None if caching is off or unavailable.
+    """
+    if not enabled or sqlite3 is None or max_entries <= 0:
+        return None
+    filename = default_cache_filename()
+    if filename is None:
+        return None
+    return ResultCache(filename, max_entries)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Chooses which hooks check which files.
+
+Rather than calling is_python_file and then every hook's should_process_file for each path,
+FileSelector compiles the Python file name rule and all hooks' exclude patterns into a single
+regular expression. A path is matched once however many hooks there are. Each exclude pattern is a
+lookahead with a named group; the groups that matched clear their hooks' bits in a bitmask.
+
+Optionally (`pygithooks.python-shebang`), files without an extension are Python files too if they
+start with a Python shebang line such as `#!/usr/bin/env python`. Only their first bytes are
+kept, all read through one `git cat-file --batch`.
+"""
+
+import re
+
+from blobs import BlobPrefixReader
+
+
+# The same as os.path.splitext(path)[1] == ".py", and == "" (no extension).
+PYTHON_NAME_PATTERN = r"(?:[\s\S]*/)?\.*[^./][^/]*\.py\Z"
+NO_EXTENSION_PATTERN = r"(?:[\s\S]*/)?\.*[^./]*\Z"
+
+PYTHON_NAME_RE = re.compile(PYTHON_NAME_PATTERN)
+
+# A first line like "#!/usr/bin/env python", "#!/usr/bin/python2.7 -u" or "#! /usr/bin/env python3".
+PYTHON_SHEBANG_RE = re.compile(r"#![^\n]*\bpython[0-9.]*(?:\s|\Z)")
+
+
+def is_python_file(filename):
+    """
+    Returns True iff the file contains python code, judging by its extension.
+
+    >>> import os
+    >>> paths = ["a.py", "a/b.py", ".py", "a/..py", ".a.py", "a..py", "a.py/b", "a.pyc", "a", "a.", "..."]
+    >>> [is_python_file(path) for path in paths] == [os.path.splitext(path)[1] == ".py" for path in paths]
+    True
+    """
+    return PYTHON_NAME_RE.match(filename) is not None
+
+
+def mergeable(pattern):
+    """
+    Whether a hook's exclude pattern means the same inside the combined expression: it has no
+    flags, which would apply to the whole expression, no numbered backreferences or conditions,
+    which would be renumbered, and no named groups, which could clash with other hooks' groups.
+
+    >>> [mergeable(pattern) for pattern in [".*/migrations/", "(?i)tests/", r"(a)\\1", "(?P<x>a)", "(?P=x)"]]
+    [True, False, False, False, False]
+    """
+    try:
+        return re.compile(pattern).flags == 0 and not re.search(r"\\[1-9]|\(\?\(|\(\?P", pattern)
+    except re.error:
+        return False
+
+
+class FileSelector(object):
+    """
+    Picks the hooks that apply to each path with one regular expression match.
+
+    Hooks choose their files with an `exclude` attribute: a regular expression matched against the
+    start of the path, or None for every Python file. Hooks without one, or with a pattern that
+    can't be combined with the others, are asked through should_process_file.
+
+    >>> class Hook(object):
+    ...     def __init__(self, exclude):
+    ...         self.exclude = exclude
+    ...     def should_process_file(self, filename):
+    ...         return not (self.exclude and re.match(self.exclude, filename))
+    >>> selector = FileSelector([Hook(None), Hook(".*/migrations/"), Hook("(?i)TESTS/")])
+    >>> [selector.hook_mask(path) for path in ["app/models.py", "app/migrations/0001.py", "tests/a.py", "README"]]
+    [7, 5, 3, 0]
+    >>> selector.select("app/migrations/0001.py"), selector.select("bin/tool")
+    (([0, 2], False), (None, False))
+    >>> FileSelector([Hook(None)], detect_shebangs=True).select("bin/tool")
+    ([0], True)
+    """
+
+    def __init__(self, hooks, detect_shebangs=False):
+        self.hooks = hooks
+        self.detect_shebangs = detect_shebangs
+        self.all_hooks_mask = (1 << len(hooks)) - 1
+        # (group name, hook bit) for each exclude pattern in the combined expression
+        exclude_groups = []
+        # hooks asked one path at a time
+        self.fallback_indexes = []
+        # other files fail straight away, without trying the excludes
+        if detect_shebangs:
+            name_pattern = "(?=(?P<pygithooks_python>%s)|(?P<pygithooks_no_extension>%s))" % (
+                PYTHON_NAME_PATTERN, NO_EXTENSION_PATTERN)
+        else:
+            name_pattern = "(?=(?P<pygithooks_python>%s))" % PYTHON_NAME_PATTERN
+        exclude_parts = []
+        for hook_index, hook in enumerate(hooks):
+            if not hasattr(hook, "exclude"):
+                self.fallback_indexes.append(hook_index)
+            elif hook.exclude and not mergeable(hook.exclude):
+                self.fallback_indexes.append(hook_index)
+            elif hook.exclude:
+                group = "pygithooks_exclude_%d" % hook_index
+                # each alternative either matches the pattern here or nothing, so all are tried
+                exclude_parts.append("(?:(?=(?P<%s>(?:%s)))|)" % (group, hook.exclude))
+                exclude_groups.append((group, 1 << hook_index))
+        try:
+            self.path_re = re.compile(name_pattern + "".join(exclude_parts))
+        except (re.error, AssertionError):
+            # the patterns don't combine (Python 2 also allows only 100 groups); ask each hook instead
+            self.path_re = re.compile(name_pattern)
+            self.fallback_indexes = sorted(self.fallback_indexes + [hook_index for hook_index, hook in enumerate(hooks)
+                                                                    if getattr(hook, "exclude", None)])
+            exclude_groups = []
+        # positions in match.groups(), so one call gives every rule's outcome
+        self.python_position = self.path_re.groupindex["pygithooks_python"] - 1
+        self.exclude_positions = [(self.path_re.groupindex[group] - 1, bit) for group, bit in exclude_groups]
+        self._hook_indexes = {}
+        self.prefix_reader = None
+
+    def _match(self, path):
+        """
+        (the groups path matched, whether it's a Python file only if it has a Python shebang), or
+        (None, False) if it isn't a Python file.
+        """
+        match = self.path_re.match(path)
+        if match is None:
+            return None, False
+        groups = match.groups()
+        return groups, groups[self.python_position] is None
+
+    def _mask(self, path, groups):
+        mask = self.all_hooks_mask
+        for position, bit in self.exclude_positions:
+            if groups[position] is not None:
+                mask &= ~bit
+        for hook_index in self.fallback_indexes:
+            if not self.hooks[hook_index].should_process_file(path):
+                mask &= ~(1 << hook_index)
+        return mask
+
+    def hook_mask(self, path):
+        """
+        A bitmask of the hooks that apply to path, bit i for hooks[i]; 0 if it isn't a Python file.
+        """
+        groups, unused_needs_shebang = self._match(path)
+        if groups is None:
+            return 0
+        return self._mask(path, groups)
+
+    def hook_indexes(self, mask):
+        """
+        The indexes of the hooks in mask, in order.
+        """
+        if mask not in self._hook_indexes:
+            self._hook_indexes[mask] = [hook_index for hook_index in range(len(self.hooks)) if mask & (1 << hook_index)]
+        return list(self._hook_indexes[mask])
+
+    def select(self, path):
+        """
+        (hook_indexes, needs_shebang): the hooks that apply to path, and whether they only do if
+        its contents start with a Python shebang (see with_python_shebangs). hook_indexes is None
+        if path isn't a Python file.
+        """
+        groups, needs_shebang = self._match(path)
+        if groups is None:
+            return None, False
+        return self.hook_indexes(self._mask(path, groups)), needs_shebang
+
+    def with_python_shebangs(self, selections, object_name):
+        """
+        Generate (item, hook_indexes) for each (item, hook_indexes, needs_shebang) of selections,
+        in order, leaving out those that need a shebang and whose blob, object_name(item), doesn't
+        start with a Python one.
+
+        The first bytes of those blobs are read through one cat-file process, as selections come.
+        """
+        if not self.detect_shebangs:
+            for item, hook_indexes, unused_needs_shebang in selections:
+                yield item, hook_indexes
+            return
+        if self.prefix_reader is None:
+            self.prefix_reader = BlobPrefixReader()
+        # the others get an empty request, which cat-file answers straight away, keeping the order
+        prefixes = self.prefix_reader.read_blobs(selections,
+                                                 object_name=lambda selection: selection[2] and object_name(selection[0]) or "")
+        for (item, hook_indexes, needs_shebang), unused_object_id, prefix in prefixes:
+            if needs_shebang and not (prefix and PYTHON_SHEBANG_RE.match(prefix)):
+                continue
+            yield item, hook_indexes
+
+    def abort(self):
+        if self.prefix_reader is not None:
+            self.prefix_reader.abort()
+            self.prefix_reader = None
+
+    def close(self):
+        if self.prefix_reader is not None:
+            self.prefix_reader.close()
+            self.prefix_reader = None
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+server.py
+
+A long-lived hook server for one repository, so commits skip starting Python, importing the
+hooks and pep8, and loading their state.
+
+    server.py start | serve | stop | status [--idle-timeout SECONDS]
+
+`start` runs the server in the background; `serve` runs it in the foreground. It listens on
+`.git/pygithooks/server.sock`, and client.py (what the pre-commit hook runs) sends it each
+commit's arguments, working directory and environment. The hooks then run here exactly as
+precommit.py would run them, with their output streamed back to the client.
+
+Configuration is reloaded for every request (cheaply; see util.load_config_snapshot). The hooks,
+their compiled file selector and the open result cache are kept from one request to the next
+while it stays the same (see precommit.keep_warm). If
+pygithooks' own code changes, the server tells the next client to run the hooks itself, then
+exits. It also exits after a while without requests.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+import glob
+import marshal
+import optparse
+import os
+import socket
+import subprocess
+import sys
+import traceback
+
+from check_pep8 import PEP8_PATH
+from client import ServerUnavailable, read_message, request, write_message
+import precommit
+import tracing
+from util import reset_config_snapshot, server_socket_filename, short_path
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_IDLE_TIMEOUT = 3600
+
+
+def code_fingerprint():
+    """
+    Sizes and modification times of pygithooks' code; the server is stale once these change.
+    """
+    fingerprint = []
+    for filename in sorted(glob.glob(os.path.join(CODE_DIR, "*.py"))) + [PEP8_PATH]:
+        try:
+            file_stat = os.stat(filename)
+            fingerprint.append((filename, file_stat.st_size, file_stat.st_mtime))
+        except OSError:
+            fingerprint.append((filename, None, None))
+    return fingerprint
+
+
+class OutputWriter(object):
+    """
+    A file-like object sending everything written to it to the client as output messages.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.softspace = 0
+
+    def write(self, data):
+        if data:
+            write_message(self.stream, "o", data)
+
+    def flush(self):
+        pass
+
+
+class HookServer(object):
+
+    def __init__(self, socket_filename, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.socket_filename = socket_filename
+        self.idle_timeout = idle_timeout
+        self.fingerprint = code_fingerprint()
+        self.listener = None
+        self.running = False
+        self.requests = 0
+
+    def bind(self):
+        """
+        Start listening, replacing the socket of a server that died. Returns False if one is already running.
+        """
+        if is_running(self.socket_filename):
+            return False
+        directory = os.path.dirname(self.socket_filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.socket_filename):
+            os.remove(self.socket_filename)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only this user may connect
+        old_umask = os.umask(077)
+        try:
+            self.listener.bind(short_path(self.socket_filename))
+        finally:
+            os.umask(old_umask)
+        self.listener.listen(5)
+        self.listener.settimeout(self.idle_timeout)
+        return True
+
+    def serve_forever(self):
+        """
+        Handle requests one at a time until stopped, stale or idle for idle_timeout seconds.
+        """
+        self.running = True
+        precommit.keep_warm()
+        try:
+            while self.running:
+                try:
+                    connection, unused_address = self.listener.accept()
+                except socket.timeout:
+                    break
+                connection.settimeout(None)
+                try:
+                    self.handle(connection.makefile("rb+", 0))
+                except socket.error:
+                    # the client went away; its commit is aborted anyway
+                    pass
+                finally:
+                    connection.close()
+        finally:
+            self.listener.close()
+            try:
+                os.remove(self.socket_filename)
+            except OSError:
+                pass
+
+    def handle(self, stream):
+        kind, data = read_message(stream)
+        if kind != "r":
+            return
+        message = marshal.loads(data)
+        command = message.get("command")
+        if command == "ping":
+            write_message(stream, "x", str(self.requests))
+        elif command == "stop":
+            self.running = False
+            write_message(stream, "x", "0")
+        elif command == "run":
+            if code_fingerprint() != self.fingerprint:
+                # a client runs its hooks in-process instead; a later one can start a fresh server
+                self.running = False
+                write_message(stream, "s", "pygithooks code changed")
+                return
+            self.requests += 1
+            status = self.run_hooks(message["argv"], message["cwd"], message["env"], OutputWriter(stream))
+            write_message(stream, "x", str(status))
+
+    def run_hooks(self, argv, cwd, env, output):
+        """
+        Run precommit.main(argv) as if in the client's process: from its directory, with its
+        environment (e.g. GIT_INDEX_FILE) and writing to its stdout. Returns the exit status.
+        """
+        saved_env = dict(os.environ)
+        saved_cwd = os.getcwd()
+        saved_stdout = sys.stdout
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(cwd)
+        reset_config_snapshot()
+        sys.stdout = output
+        try:
+            try:
+                status = precommit.main(argv)
+            except SystemExit, e:
+                status = e.code
+            except Exception:
+                output.write(traceback.format_exc())
+                status = 1
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                # sys.exit("message")
+                output.write("%s\n" % status)
+                status = 1
+            return status
+        finally:
+            sys.stdout = saved_stdout
+            tracing.stop_recording()
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+
+def is_running(socket_filename):
+    try:
+        request(socket_filename, dict(command="ping"))
+    except (ServerUnavailable, socket.error):
+        return False
+    return True
+
+
+def start_in_background(idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    Start a server for the current repository in a detached process, without waiting for it.
+    """
+    devnull = open(os.devnull, "r+")
+    try:
+        subprocess.Popen([sys.executable, os.path.join(CODE_DIR, "server.py"), "serve",
+                          "--idle-timeout", str(idle_timeout)],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+    finally:
+        devnull.close()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog start | serve | stop | status [--idle-timeout SECONDS]",
+                                   description="Run a warm pygithooks server for the current repository.")
+    parser.add_option("--idle-timeout", type="int", default=DEFAULT_IDLE_TIMEOUT,
+                      help="exit after this many seconds without a request [%default]")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or args[0] not in ("start", "serve", "stop", "status"):
+        parser.error("expected one of start, serve, stop or status")
+    command = args[0]
+
+    socket_filename = server_socket_filename()
+    if socket_filename is None:
+        print "Not in a git repository"
+        return 1
+
+    if command == "status":
+        try:
+            requests = request(socket_filename, dict(command="ping"))
+        except (ServerUnavailable, socket.error):
+            print "No server running"
+            return 1
+        print "Server running on %s, %s requests served" % (socket_filename, requests)
+    elif command == "stop":
+        try:
+            request(socket_filename, dict(command="stop"))
+        except (ServerUnavailable, socket.error):
+            print "No server running"
+            return 1
+    elif command == "start":
+        if is_running(socket_filename):
+            print "Server already running"
+            return 0
+        start_in_background(options.idle_timeout)
+    else:
+        server = HookServer(socket_filename, options.idle_timeout)
+        if not server.bind():
+            print "Server already running"
+            return 0
+        server.serve_forever()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
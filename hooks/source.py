@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Per-file analysis context shared by all hooks.
+
+A file is read and tokenized once; every hook that needs its bytes, lines or tokens gets
+them from the same SourceFile instead of redoing the work.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+import contextlib
+import os
+import parser
+import shutil
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+import tempfile
+import tokenize
+
+
+class SourceFile(object):
+    """
+    One version of one file.
+
+    code: the file's raw contents
+    filename: the file's path in the repository, used in messages
+    changed_lines: if only some lines' problems should be reported, a changed_lines.LineRanges of them
+    object_id: the file's blob id, if known
+    """
+
+    def __init__(self, code, filename, changed_lines=None, object_id=None):
+        self.code = code
+        self.filename = filename
+        self.changed_lines = changed_lines
+        self.object_id = object_id
+        self._lines = None
+        self._tokens = None
+        self._token_error = None
+        self._parses = None
+
+    def __str__(self):
+        return "<SourceFile %s>" % self.filename
+
+    @classmethod
+    def from_file(cls, path, filename=None, changed_lines=None):
+        with open(path, "r") as source_file:
+            return cls(source_file.read(), filename or path, changed_lines)
+
+    @contextlib.contextmanager
+    def temp_copy(self):
+        """
+        A context manager giving the name of a temp copy of the file, for code that needs a real
+        file. The copy is at the file's own path under a new temp dir, removed afterwards.
+        """
+        temp_dir = make_temp_tree([self])
+        try:
+            yield os.path.join(temp_dir, self.filename)
+        finally:
+            shutil.rmtree(temp_dir, True)
+
+    @property
+    def lines(self):
+        """
+        The file's lines, split the way file.readlines() splits them (only on "\\n").
+        """
+        if self._lines is None:
+            self._lines = StringIO.StringIO(self.code).readlines()
+        return self._lines
+
+    @property
+    def parses(self):
+        """
+        True iff Python's own (C) parser accepts the file. Much faster than tokenizing it.
+
+        False doesn't mean the file is broken, just that the parser didn't accept it, e.g. because
+        it uses `from __future__ import print_function`.
+        """
+        if self._parses is None:
+            try:
+                parser.suite(self.code)
+                self._parses = True
+            except (SyntaxError, TypeError, ValueError, MemoryError):
+                # TypeError: the code contains null bytes
+                self._parses = False
+        return self._parses
+
+    def _tokenize(self):
+        if self._tokens is None:
+            tokens = []
+            try:
+                for token in tokenize.generate_tokens(iter(self.lines).next):
+                    tokens.append(token)
+            except (tokenize.TokenError, SyntaxError), e:
+                # IndentationError is a SyntaxError; both are raised again when replayed.
+                self._token_error = e
+            self._tokens = tokens
+
+    def generate_tokens(self):
+        """
+        Generate the file's tokens like tokenize.generate_tokens, raising the same error at the
+        same point if the file can't be tokenized. The file is only tokenized once.
+        """
+        self._tokenize()
+        for token in self._tokens:
+            yield token
+        if self._token_error is not None:
+            raise self._token_error
+
+
+def make_temp_tree(sources):
+    """
+    Write each of sources, which must have distinct filenames, at its own path under a new temp
+    dir, and return the dir. The caller removes it.
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for source in sources:
+            temp_filename = os.path.join(temp_dir, source.filename)
+            if not os.path.isdir(os.path.dirname(temp_filename)):
+                os.makedirs(os.path.dirname(temp_filename))
+            with open(temp_filename, "wb") as temp_file:
+                temp_file.write(source.code)
+    except EnvironmentError:
+        shutil.rmtree(temp_dir, True)
+        raise
+    return temp_dir
+
+
+def strip_temp_dir(lines, temp_dir):
+    """
+    A tool's output lines, with temp_dir taken out of the paths in them, so they name files by
+    their paths in the repository.
+
+    >>> strip_temp_dir(["/tmp/x1/a/b.py:3:1: E101", "ok"], "/tmp/x1")
+    ['a/b.py:3:1: E101', 'ok']
+    """
+    prefix = os.path.join(temp_dir, "")
+    return [line.replace(prefix, "") for line in lines]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Optional timing of what the hooks spend their time on, turned on by `pygithooks.profile`.
+
+Spans record wall and CPU time for phases, hook runs and subprocesses. They are written as
+Chrome trace-event JSON (load it in chrome://tracing or https://ui.perfetto.dev), and
+summarized as text. When profiling is off, span() does nothing and costs next to nothing.
+"""
+
+from __future__ import with_statement   # Python 2.5 compatibility.
+try:
+    import json
+except ImportError:
+    json = None  # Python 2.5; no trace file is written.
+import os
+import threading
+import time
+
+
+def cpu_time():
+    """
+    CPU seconds (user + system) used by this process so far, across all its threads.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class TraceRecorder(object):
+    """
+    Collects complete ("X") trace events, with times in microseconds since the epoch.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def record(self, name, category, start, end, cpu_start, cpu_end, args=None):
+        event_args = dict(args or {})
+        event_args["cpu_ms"] = round((cpu_end - cpu_start) * 1000, 3)
+        self.events.append(dict(name=name,
+                                cat=category,
+                                ph="X",
+                                ts=int(start * 1000000),
+                                dur=int((end - start) * 1000000),
+                                pid=os.getpid(),
+                                tid=getattr(threading.currentThread(), "ident", 0),
+                                args=event_args))
+
+
+class Span(object):
+    """
+    Context manager timing its block. More args can be added to span.args inside the block.
+    """
+
+    def __init__(self, recorder, name, category, args):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu_start = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.record(self.name, self.category, self.start, time.time(),
+                             self.cpu_start, cpu_time(), self.args)
+
+
+class NullSpan(object):
+
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_recorder = None
+
+
+def start_recording():
+    """
+    Start recording spans in this process, discarding any recorded so far.
+    """
+    global _recorder
+    _recorder = TraceRecorder()
+
+
+def stop_recording():
+    """
+    Stop recording spans in this process, discarding any recorded so far.
+    """
+    global _recorder
+    _recorder = None
+
+
+def is_recording():
+    return _recorder is not None
+
+
+def span(name, category="phase", **args):
+    """
+    A context manager recording a span around its block if recording is on.
+
+    Categories used: "phase", "hook" and "fix" (args: file), "blob" and "subprocess" (args: argv).
+    """
+    if _recorder is None:
+        return NullSpan()
+    return Span(_recorder, name, category, args)
+
+
+def traced(iterable, name, category, describe=None):
+    """
+    Generate iterable's items, recording a span for the wait for each one.
+
+    describe, if given, returns a dict of args for an item.
+    """
+    iterator = iter(iterable)
+    while True:
+        item_span = span(name, category)
+        with item_span:
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+        if describe is not None:
+            item_span.args.update(describe(item))
+        yield item
+
+
+def record(name, category, start, end, cpu_start, cpu_end, **args):
+    """
+    Record a span that has already finished, e.g. one that began before recording was turned on.
+    """
+    if _recorder is not None:
+        _recorder.record(name, category, start, end, cpu_start, cpu_end, args)
+
+
+def take_events():
+    """
+    Remove and return the events recorded so far, e.g. to send them from a worker process.
+    """
+    if _recorder is None:
+        return []
+    events, _recorder.events = _recorder.events, []
+    return events
+
+
+def add_events(events):
+    """
+    Add events recorded elsewhere, e.g. in a worker process.
+    """
+    if _recorder is not None:
+        _recorder.events.extend(events)
+
+
+def summarize(events, limit=5):
+    """
+    Lines of text summarizing events: phases, then the slowest hooks, files and subprocesses.
+    """
+    def seconds(microseconds):
+        return "%.3fs" % (microseconds / 1000000.0)
+
+    lines = []
+    phases = [event for event in events if event["cat"] == "phase"]
+    if phases:
+        lines.append("phases: " + ", ".join("%s %s (%.3fs CPU)" % (event["name"], seconds(event["dur"]),
+                                                                   event["args"]["cpu_ms"] / 1000.0)
+                                            for event in phases))
+
+    hook_events = [event for event in events if event["cat"] == "hook"]
+    hook_totals = {}
+    file_totals = {}
+    for event in hook_events:
+        hook_count, hook_time, fast_path_count = hook_totals.get(event["name"], (0, 0, 0))
+        hook_totals[event["name"]] = (hook_count + 1, hook_time + event["dur"],
+                                      fast_path_count + bool(event["args"].get("fast_path")))
+        filename = event["args"].get("file")
+        file_totals[filename] = file_totals.get(filename, 0) + event["dur"]
+    if hook_totals:
+        lines.append("slowest hooks:")
+        for name, (count, total, fast_path_count) in sorted(hook_totals.items(), key=lambda item: -item[1][1])[:limit]:
+            lines.append("  %s: %s over %d files, %d decided by its fast path" %
+                         (name, seconds(total), count, fast_path_count))
+        lines.append("slowest files (all hooks):")
+        for filename, total in sorted(file_totals.items(), key=lambda item: -item[1])[:limit]:
+            lines.append("  %s: %s" % (filename, seconds(total)))
+
+    commands = [event for event in events if event["cat"] == "subprocess"]
+    if commands:
+        command_total = sum(event["dur"] for event in commands)
+        lines.append("subprocesses: %d, %s in total; slowest:" % (len(commands), seconds(command_total)))
+        for event in sorted(commands, key=lambda event: -event["dur"])[:limit]:
+            lines.append("  %s: %s" % (" ".join(event["args"]["argv"]), seconds(event["dur"])))
+    return lines
+
+
+def write_trace(filename):
+    """
+    Write the recorded events to filename as Chrome trace-event JSON. Returns the summary lines.
+    """
+    events = sorted(_recorder.events, key=lambda event: event["ts"])
+    if json is not None:
+        with open(filename, "w") as trace_file:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), trace_file)
+    return summarize(events)
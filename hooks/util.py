@@ -3,70 +3,557 @@
 Shared pygithooks utils.
 """
 
+from __future__ import with_statement   # Python 2.5 compatibility.
+try:
+    import json
+except ImportError:
+    json = None  # Python 2.5; the config cache is skipped.
+import os
 import shlex
+import signal
 import subprocess
+import tempfile
+import threading
+import time
+
+import tracing
+
+
+def split_command(command):
+    """
+    Commands may be given as a string (split shell-style) or as an argument list.
+    """
+    if isinstance(command, basestring):
+        return shlex.split(command)
+    return list(command)
+
+
+def kill_process(process):
+    """
+    Kill a subprocess.Popen's process, if it's still there. (Popen.kill is Python 2.6+.)
+    """
+    try:
+        if hasattr(process, "kill"):
+            process.kill()
+        else:
+            os.kill(process.pid, signal.SIGKILL)
+    except OSError:
+        # it already exited
+        pass
+
+
+def short_path(path):
+    """
+    path relative to the current directory, e.g. for a socket, whose path is limited to about 100
+    bytes. Python 2.5 has no os.path.relpath, so there it stays absolute.
+    """
+    if hasattr(os.path, "relpath"):
+        return os.path.relpath(path)
+    return path
+
+
+def command_span(argv):
+    """
+    A tracing span for running argv, named after the program and its subcommand.
+    """
+    return tracing.span(" ".join(argv[:2]), "subprocess", argv=argv)
 
 
 def run_command(command, shell=False):
-    command_subprocess = subprocess.Popen(shlex.split(command),
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE,
-                                          shell=shell)
-    command_out, command_err = command_subprocess.communicate()
-    return_code = command_subprocess.returncode
+    argv = split_command(command)
+    with command_span(argv) as span:
+        command_subprocess = subprocess.Popen(argv,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.PIPE,
+                                              shell=shell)
+        command_out, command_err = command_subprocess.communicate()
+        return_code = command_subprocess.returncode
+        span.args["returncode"] = return_code
     return command_out, command_err, return_code
 
 
+class BackgroundCommand(object):
+    """
+    A command started now and waited for later, so the caller can do other work, or run other
+    commands, while it runs.
+
+    A helper thread feeds it input and collects its output, so it can't block on a full pipe.
+
+    >>> command = BackgroundCommand(["cat"], input="hello")
+    >>> command.wait()
+    ('hello', '', 0)
+    """
+
+    def __init__(self, command, input=None):
+        self.argv = split_command(command)
+        self.result = None
+        self.process = subprocess.Popen(self.argv,
+                                        stdin=subprocess.PIPE if input is not None else None,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._communicate, args=(input,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _communicate(self, input):
+        with command_span(self.argv) as span:
+            command_out, command_err = self.process.communicate(input)
+            span.args["returncode"] = self.process.returncode
+        self.result = (command_out, command_err, self.process.returncode)
+
+    def wait(self):
+        """
+        Wait for the command to finish. Returns (stdout, stderr, return code), like run_command.
+        """
+        self.thread.join()
+        if self.result is None:
+            raise RuntimeError("command could not be run", self.argv)
+        return self.result
+
+
+def stream_records(command, separator="\0"):
+    """
+    Run command, generating the separator-terminated records of its output as they arrive.
+
+    Raises RuntimeError, after the last record, if the command fails or writes to stderr.
+
+    >>> list(stream_records(["printf", "a\\\\0b c\\\\0"]))
+    ['a', 'b c']
+    """
+    argv = split_command(command)
+    start, cpu_start = time.time(), tracing.cpu_time()
+    # stderr goes to a file, so a chatty command can't block on a pipe we aren't reading yet
+    err_file = tempfile.TemporaryFile()
+    command_subprocess = subprocess.Popen(argv,
+                                          stdout=subprocess.PIPE,
+                                          stderr=err_file)
+    try:
+        pending = ""
+        while True:
+            chunk = os.read(command_subprocess.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            records = (pending + chunk).split(separator)
+            pending = records.pop()
+            for record in records:
+                yield record
+        if pending:
+            yield pending
+
+        return_code = command_subprocess.wait()
+        err_file.seek(0)
+        command_err = err_file.read()
+        if return_code or command_err:
+            raise RuntimeError("command returned an error", command, command_err)
+    finally:
+        if command_subprocess.poll() is None:
+            # the caller stopped early
+            kill_process(command_subprocess)
+            command_subprocess.wait()
+        command_subprocess.stdout.close()
+        err_file.close()
+        # covers the time the caller spent on each record, too
+        tracing.record(" ".join(argv[:2]), "subprocess", start, time.time(), cpu_start, tracing.cpu_time(),
+                       argv=argv, returncode=command_subprocess.returncode)
+
+
+def _default_sigpipe():
+    # Python ignores SIGPIPE, and children inherit that; a command writing to a closed pipe
+    # should just die, as it would in a shell.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
 def run_piped_commands(commands, shell=False):
     """
     Run multiple commands, chaining stdout to stdin a la shell pipelining.
 
+    Returns (output of the last command, stderr of all of them, return code). The return code is
+    the last command's, or if that succeeded, that of the last earlier command that failed (like
+    bash's pipefail); commands killed by SIGPIPE after a later one exited don't count.
+
     >>> run_piped_commands(["ls -l util.py", "wc -l"])[0].strip()
     '1'
     >>> run_piped_commands(["ls -l util.py", "wc -l"])[1:]
     ('', 0)
+    >>> run_piped_commands(["yes", "head -n 3"])
+    ('y\\ny\\ny\\n', '', 0)
     """
     if not commands:
         raise ValueError("run_piped_commands requires at least one command")
 
-    stdin = None
-    for command in commands:
-        command_subprocess = subprocess.Popen(shlex.split(command),
-                                              stdin=stdin,
-                                              stdout=subprocess.PIPE,
-                                              stderr=subprocess.PIPE,
-                                              shell=shell)
-        stdin = command_subprocess.stdout
-        # The sample code at http://docs.python.org/library/subprocess.html
-        # seems to indicate the following line is needed, but it breaks things
-        # for me...
-        # command_subprocess.stdout.close()  # Allow prior process to receive a SIGPIPE if this process exits
-
-    command_out, command_err = command_subprocess.communicate()
-    return_code = command_subprocess.returncode
+    argvs = [split_command(command) for command in commands]
+    pipeline_argv = []
+    for argv in argvs:
+        pipeline_argv += (["|"] if pipeline_argv else []) + argv
+    with command_span(pipeline_argv) as span:
+        # Every command's stderr goes to one file, so none of them can block on a full pipe nobody reads.
+        err_file = tempfile.TemporaryFile()
+        processes = []
+        try:
+            stdin = None
+            for argv in argvs:
+                command_subprocess = subprocess.Popen(argv,
+                                                      stdin=stdin,
+                                                      stdout=subprocess.PIPE,
+                                                      stderr=err_file,
+                                                      shell=shell,
+                                                      preexec_fn=_default_sigpipe)
+                if stdin is not None:
+                    # Only the next command reads this pipe now; closing our copy lets the previous
+                    # command get SIGPIPE if the next one exits early, instead of blocking forever.
+                    stdin.close()
+                stdin = command_subprocess.stdout
+                processes.append(command_subprocess)
+
+            command_out = command_subprocess.communicate()[0]
+            return_codes = [process.wait() for process in processes]
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    kill_process(process)
+                    process.wait()
+            err_file.seek(0)
+            command_err = err_file.read()
+            err_file.close()
+
+        return_code = return_codes[-1]
+        if not return_code:
+            for earlier_return_code in reversed(return_codes[:-1]):
+                if earlier_return_code and earlier_return_code != -signal.SIGPIPE:
+                    return_code = earlier_return_code
+                    break
+        span.args["returncode"] = return_code
     return command_out, command_err, return_code
 
 
-def get_config(config_key, as_bool=False, default=None):
+def file_fingerprint(filename):
+    """
+    A file's size and modification time; None if it doesn't exist.
+    """
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+    return (file_stat.st_size, file_stat.st_mtime)
+
+
+def get_git_dir():
     """
-    Retrieves the value of pygithooks.<config_key> from git config, optionally forcing to be boolean.
+    Returns the path of the current repository's git directory, or None if it can't be found without running git.
+
+    Hooks run from the top of the work tree, so this is almost always just ".git".
     """
-    git_config_command = "git config --null %(bool_flag)s --get pygithooks.%(config_key)s" % dict(config_key=config_key,
-                                                                                                  bool_flag="--bool" if as_bool else "")
-    git_out, git_err, git_rc = run_command(git_config_command)
+    git_dir = os.environ.get("GIT_DIR")
+    if git_dir:
+        return git_dir
 
-    if git_err:
-        raise RuntimeError("git config command returned an error", git_config_command, git_err)
-    if not git_out or git_rc:
-        return default
+    directory = os.getcwd()
+    while True:
+        dot_git = os.path.join(directory, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # a linked work tree or submodule: .git is a file pointing at the real git dir
+            with open(dot_git) as dot_git_file:
+                contents = dot_git_file.read().strip()
+            if contents.startswith("gitdir: "):
+                return os.path.join(directory, contents[len("gitdir: "):])
+            return None
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
 
-    null_index = git_out.find(chr(0))
-    if null_index < 0:
-        return default
 
-    config_val = git_out[:null_index]
+def parse_config_bool(value):
+    """
+    Interpret a git config value as a boolean, the way `git config --bool` does.
+
+    value is None for a key given without "=", which git treats as true.
+
+    >>> [parse_config_bool(v) for v in (None, "yes", "On", "1", "false", "", "0")]
+    [True, True, True, True, False, False, False]
+    """
+    if value is None:
+        return True
+    lowered = value.strip().lower()
+    if lowered in ("true", "yes", "on"):
+        return True
+    if lowered in ("false", "no", "off", ""):
+        return False
+    try:
+        return int(lowered) != 0
+    except ValueError:
+        raise ValueError("bad boolean config value %r" % value)
+
+
+def parse_config_int(value):
+    """
+    Interpret a git config value as an integer, the way `git config --int` does.
+
+    >>> [parse_config_int(v) for v in ("12", "2k", "3M", "1g")]
+    [12, 2048, 3145728, 1073741824]
+    """
+    if value is None:
+        raise ValueError("bad numeric config value %r" % value)
+    multipliers = dict(k=1024, m=1024 ** 2, g=1024 ** 3)
+    digits = value.strip()
+    multiplier = multipliers.get(digits[-1:].lower(), 1)
+    if multiplier != 1:
+        digits = digits[:-1]
+    try:
+        return int(digits) * multiplier
+    except ValueError:
+        raise ValueError("bad numeric config value %r" % value)
 
-    if as_bool:
-        return config_val == "true"
-    else:
-        return config_val
+
+def normalize_config_key(key):
+    """
+    Normalize a full config key the way git does: section and variable names are
+    case-insensitive, subsection names are not.
+
+    >>> normalize_config_key("PyGitHooks.Incremental.Verbose")
+    'pygithooks.Incremental.verbose'
+    """
+    section, dot, rest = key.partition(".")
+    subsection, dot, variable = rest.rpartition(".")
+    if subsection:
+        return "%s.%s.%s" % (section.lower(), subsection, variable.lower())
+    return "%s.%s" % (section.lower(), variable.lower())
+
+
+class ConfigSnapshot(object):
+    """
+    All pygithooks.* configuration, read from git in a single call.
+
+    Values are kept raw (None for a key given without "="); the last definition of a key wins,
+    as it does for `git config --get`.
+    """
+
+    # git config -z --get-regexp matches against the normalized (lowercased) key.
+    CONFIG_REGEXP = "^(pygithooks|include|includeif)\\."
+
+    def __init__(self, entries=()):
+        self.values = {}
+        for key, value in entries:
+            self.values[normalize_config_key(key)] = value
+
+    @classmethod
+    def from_git(cls):
+        """
+        Load a snapshot with one `git config` call.
+
+        Returns (snapshot, origins), where origins lists the files the values (and any include
+        directives) came from, or is None if git could not report them.
+        """
+        git_config_command = ["git", "config", "-z", "--show-origin", "--get-regexp", cls.CONFIG_REGEXP]
+        git_out, git_err, git_rc = run_command(git_config_command)
+        show_origin = True
+        if git_err:
+            # git older than 2.8 has no --show-origin.
+            show_origin = False
+            git_config_command.remove("--show-origin")
+            git_out, git_err, git_rc = run_command(git_config_command)
+            if git_err:
+                raise RuntimeError("git config command returned an error", git_config_command, git_err)
+
+        fields = git_out.split("\0")
+        if fields and fields[-1] == "":
+            fields.pop()
+        if show_origin:
+            records = zip(fields[0::2], fields[1::2])
+        else:
+            records = [(None, record) for record in fields]
+
+        entries = []
+        origins = [] if show_origin else None
+        for origin, record in records:
+            key, newline, value = record.partition("\n")
+            if not newline:
+                value = None
+            if origins is not None:
+                if origin.startswith("file:"):
+                    origin_path = origin[len("file:"):]
+                    origins.append(origin_path)
+                    if key.startswith("include") and value:
+                        origins.append(os.path.join(os.path.dirname(origin_path), os.path.expanduser(value)))
+                else:
+                    # from the command line, the environment or a blob: there is no file to watch.
+                    origins = None
+            if key.startswith("pygithooks."):
+                entries.append((key, value))
+        return cls(entries), origins
+
+    def get(self, config_key, as_bool=False, default=None, as_int=False):
+        """
+        Same contract as get_config, answered from the snapshot.
+        """
+        full_key = normalize_config_key("pygithooks." + config_key)
+        if full_key not in self.values:
+            return default
+        value = self.values[full_key]
+        if as_bool:
+            try:
+                return parse_config_bool(value)
+            except ValueError, e:
+                raise RuntimeError("git config value is not a boolean", full_key, str(e))
+        if as_int:
+            try:
+                return parse_config_int(value)
+            except ValueError, e:
+                raise RuntimeError("git config value is not an integer", full_key, str(e))
+        if value is None:
+            return ""
+        return value
+
+    def subsections(self, prefix):
+        """
+        The names under pygithooks.<prefix>.* that have keys of their own, sorted.
+
+        >>> snapshot = ConfigSnapshot([("pygithooks.checker.flake8.command", "flake8"),
+        ...                            ("pygithooks.checker.flake8.batch", "false"),
+        ...                            ("pygithooks.checker.mypy.command", "mypy"),
+        ...                            ("pygithooks.jobs", "4")])
+        >>> snapshot.subsections("checker")
+        ['flake8', 'mypy']
+        """
+        full_prefix = "pygithooks.%s." % prefix
+        names = set()
+        for key in self.values:
+            if key.startswith(full_prefix):
+                name, dot, unused_variable = key[len(full_prefix):].rpartition(".")
+                if name:
+                    names.add(name)
+        return sorted(names)
+
+
+def _config_files(origins):
+    """
+    Every file whose modification would change the snapshot: git's standard config locations,
+    plus wherever the values and include directives came from.
+    """
+    home = os.path.expanduser("~")
+    xdg_config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")
+    config_files = ["/etc/gitconfig",
+                    os.environ.get("GIT_CONFIG_SYSTEM", ""),
+                    os.environ.get("GIT_CONFIG_GLOBAL", ""),
+                    os.path.join(home, ".gitconfig"),
+                    os.path.join(xdg_config_home, "git", "config")]
+    git_dir = get_git_dir()
+    config_files += [os.path.join(git_dir, "config"), os.path.join(git_dir, "config.worktree")]
+    config_files += origins
+    return sorted(set(os.path.abspath(filename) for filename in config_files if filename))
+
+
+def _config_fingerprint(config_files):
+    fingerprint = []
+    for filename in config_files:
+        try:
+            file_stat = os.stat(filename)
+            fingerprint.append([filename, file_stat.st_mtime, file_stat.st_size])
+        except OSError:
+            fingerprint.append([filename, None, None])
+    # git also reads configuration from the environment (e.g. `git -c`), which we don't track.
+    environment = sorted([key, value] for key, value in os.environ.items() if key.startswith("GIT_CONFIG"))
+    return [fingerprint, environment]
+
+
+def _config_cache_filename():
+    git_dir = get_git_dir()
+    if git_dir is None or json is None:
+        return None
+    return os.path.join(git_dir, "pygithooks", "config-cache.json")
+
+
+def server_socket_filename():
+    """
+    Where a warm hook server for this repository listens (see server.py), or None if there's no git dir.
+    """
+    git_dir = get_git_dir()
+    if git_dir is None:
+        return None
+    return os.path.join(os.path.abspath(git_dir), "pygithooks", "server.sock")
+
+
+def load_config_snapshot():
+    """
+    Load the pygithooks config snapshot, from the on-disk cache if none of the config files changed.
+    """
+    cache_filename = _config_cache_filename()
+    if cache_filename is not None:
+        try:
+            with open(cache_filename) as cache_file:
+                cached = json.load(cache_file)
+            if cached["fingerprint"] == _config_fingerprint(cached["files"]):
+                return ConfigSnapshot((key.encode("utf-8"), value if value is None else value.encode("utf-8"))
+                                      for key, value in cached["entries"])
+        except (IOError, ValueError, KeyError, TypeError):
+            # missing, unreadable or stale cache; just ask git.
+            pass
+
+    snapshot, origins = ConfigSnapshot.from_git()
+
+    if cache_filename is not None and origins is not None:
+        config_files = _config_files(origins)
+        cached = dict(files=config_files,
+                      fingerprint=_config_fingerprint(config_files),
+                      entries=sorted(snapshot.values.items()))
+        try:
+            write_file_atomically(cache_filename, json.dumps(cached))
+        except UnicodeDecodeError:
+            # config values that aren't utf-8 can't go through json; skip the cache.
+            pass
+
+    return snapshot
+
+
+def write_file_atomically(filename, contents):
+    """
+    Write contents to filename via a rename, so concurrent readers never see a partial file.
+
+    Failures are ignored: everything we write this way is a cache.
+    """
+    try:
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_fd, temp_filename = tempfile.mkstemp(dir=directory)
+        with os.fdopen(temp_fd, "wb") as temp_file:
+            temp_file.write(contents)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        pass
+
+
+_config_snapshot = None
+
+
+def get_config_snapshot():
+    global _config_snapshot
+    if _config_snapshot is None:
+        _config_snapshot = load_config_snapshot()
+    return _config_snapshot
+
+
+def reset_config_snapshot():
+    """
+    Forget the loaded configuration, so the next get_config reads it again.
+    """
+    global _config_snapshot
+    _config_snapshot = None
+
+
+def get_config(config_key, as_bool=False, default=None, as_int=False):
+    """
+    Retrieves the value of pygithooks.<config_key> from git config, optionally forcing to be boolean or integer.
+
+    All keys are read at once on first use (see ConfigSnapshot), so later calls don't run git.
+    """
+    return get_config_snapshot().get(config_key, as_bool=as_bool, default=default, as_int=as_int)
+
+
+def get_config_subsections(prefix):
+    """
+    The names configured under pygithooks.<prefix>.*, e.g. each checker's name for "checker".
+    """
+    return get_config_snapshot().subsections(prefix)